@@ -1,70 +1,200 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-# Make Title/Abstract screening Excel from master_refs_dedup/raw
+# Make Title/Abstract screening Excel from master_bibliography (dedupe's output), else master_refs_dedup/raw
+#   python code/06_make_screening_sheet.py                      -> data_clean/TitleAbs_Screening.xlsx
+#   python code/06_make_screening_sheet.py --shards 4 [--by hash]
+#                                                               -> data_clean/screening_shards/*.xlsx (one per reviewer)
+#   python code/06_make_screening_sheet.py --merge [FILES...]   -> TitleAbs_Screening_merged.xlsx + screening_conflicts.csv
 
-import os, hashlib, pandas as pd
+import os, sys, glob, hashlib, argparse, pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+import bib_perf, bib_store
+from bib_io import as_text, read_csv_any, read_sidecar, write_screening_xlsx, write_sidecar
+from bib_perf import step
+
+OUT_XLSX = "data_clean/TitleAbs_Screening.xlsx"
+SHARD_DIR = "data_clean/screening_shards"
+MERGED_XLSX = "data_clean/TitleAbs_Screening_merged.xlsx"
+CONFLICTS_CSV = "data_clean/screening_conflicts.csv"
+DECISION_COLS = ["incl_titleabs_yesno", "exclusion_reason"]
+# first one found is screened; run_pipeline.py feeds the same master_bibliography
+SOURCES = ["data_clean/master_bibliography.csv", "data_clean/master_refs_dedup.csv", "data_clean/master_refs_raw.csv"]
 
 def read_any(path):
-    # 自动尝试多种编码，避免中文乱码/报错
-    for enc in ("utf-8", "utf-8-sig", "gb18030", "latin-1"):
-        try:
-            return pd.read_csv(path, dtype=str, encoding=enc).fillna("")
-        except Exception:
-            pass
-    # 最后再试一次，让报错抛出
-    return pd.read_csv(path, dtype=str)
-
-os.makedirs("data_clean", exist_ok=True)
-
-src = None
-for p in ["data_clean/master_refs_dedup.csv", "data_clean/master_refs_raw.csv"]:
-    if os.path.exists(p):
-        src = p
-        break
-if src is None:
-    raise SystemExit("No input CSV found. Put data_clean/master_refs_dedup.csv or master_refs_raw.csv")
-
-df = read_any(src)
-cols = [c.lower() for c in df.columns]
-def pick(*names):
-    for n in names:
-        if n.lower() in cols: return n
-
-col_title   = pick("title","ti")
-col_authors = pick("authors","au","author")
-col_year    = pick("year","py","yr")
-col_journal = pick("journal","source","so")
-col_abs     = pick("abstract","ab")
-col_kw      = pick("keywords","kw")
-col_doi     = pick("doi")
-col_url     = pick("url","link")
-use = [c for c in [col_title,col_authors,col_year,col_journal,col_abs,col_kw,col_doi,col_url] if c]
-work = df[use].copy() if use else df.copy()
-
-# study_id
-if "study_id" in df.columns:
-    work.insert(0,"study_id",df["study_id"].astype(str))
-else:
-    ids = [(hashlib.md5(((r.get(col_title,"") or "")+"|"+(r.get(col_year,"") or "")).encode("utf-8","ignore")).hexdigest()[:12]) for _,r in df.iterrows()]
-    work.insert(0,"study_id",ids)
-
-# Screening columns
-work.insert(1,"incl_titleabs_yesno","")
-work.insert(2,"exclusion_reason","")
-
-# 写 Excel
-out_xlsx = "data_clean/TitleAbs_Screening.xlsx"
-with pd.ExcelWriter(out_xlsx, engine="openpyxl") as w:
-    work.to_excel(w, index=False, sheet_name="Screening")
-    pd.DataFrame({"Allowed_Values":["NOT_MIDDLE_SCHOOL","NOT_CHINA","NOT_QUANT","NO_EFFECT_SIZE","DUPLICATE_DATASET","THEORY_ONLY","OTHER"]}).to_excel(w, index=False, sheet_name="Dictionary")
-    pd.DataFrame({"YesNo":["yes","no"]}).to_excel(w, index=False, sheet_name="YesNo")
-
-# 下拉菜单
-from openpyxl import load_workbook
-from openpyxl.worksheet.datavalidation import DataValidation
-wb = load_workbook(out_xlsx); ws = wb["Screening"]; max_row = ws.max_row
-dv_yesno = DataValidation(type="list", formula1="=YesNo!$A$2:$A$3", allow_blank=True); ws.add_data_validation(dv_yesno); dv_yesno.add(f"B2:B{max_row}")
-last_reason = wb["Dictionary"].max_row
-dv_reason = DataValidation(type="list", formula1=f"=Dictionary!$A$2:$A${last_reason}", allow_blank=True); ws.add_data_validation(dv_reason); dv_reason.add(f"C2:C{max_row}")
-wb.save(out_xlsx)
-print(f"Created {out_xlsx}")
+    df = read_sidecar(path, dtype=str)  # typed copy from the previous stage, if current
+    if df is not None: return df
+    # 自动识别编码（BOM/UTF-8/GB18030/latin-1），只解析一次，避免中文乱码/报错
+    return read_csv_any(path, dtype=str).fillna("")
+
+def build_sheet(df=None):
+    # df: the deduplicated list already in memory (run_pipeline.py)
+    if df is None:
+        src = None
+        for p in SOURCES:
+            if os.path.exists(p):
+                src = p
+                break
+        if src is None:
+            raise SystemExit(f"No input CSV found. Expected one of {', '.join(SOURCES)}")
+        df = read_any(src)
+    else:
+        df = as_text(df)  # same cells as reading it back from the CSV
+    cols = [c.lower() for c in df.columns]
+    def pick(*names):
+        for n in names:
+            if n.lower() in cols: return n
+
+    col_title   = pick("title","ti")
+    col_authors = pick("authors","au","author")
+    col_year    = pick("year","py","yr")
+    col_journal = pick("journal","source","so")
+    col_abs     = pick("abstract","ab")
+    col_kw      = pick("keywords","kw")
+    col_doi     = pick("doi")
+    col_url     = pick("url","link")
+    use = [c for c in [col_title,col_authors,col_year,col_journal,col_abs,col_kw,col_doi,col_url] if c]
+    work = df[use].copy() if use else df.copy()
+
+    # study_id
+    if "study_id" in df.columns:
+        work.insert(0,"study_id",df["study_id"].astype(str))
+    else:
+        blank = pd.Series("", index=df.index)
+        t = df[col_title] if col_title else blank
+        y = df[col_year] if col_year else blank
+        ids = [hashlib.md5((a+"|"+b).encode("utf-8","ignore")).hexdigest()[:12] for a, b in zip(t, y)]
+        work.insert(0,"study_id",ids)
+
+    # Screening columns
+    work.insert(1,"incl_titleabs_yesno","")
+    work.insert(2,"exclusion_reason","")
+    return work
+
+def shard_of(work, n, by):
+    # count: contiguous blocks of equal size; hash: a record keeps its shard
+    # when the master list grows or is re-sorted
+    if by == "hash":
+        return work["study_id"].map(lambda s: int(hashlib.md5(s.encode("utf-8")).hexdigest()[:8], 16) % n)
+    size = max(1, -(-len(work) // n))
+    return pd.Series([k // size for k in range(len(work))], index=work.index)
+
+def _write_shard(path, frame):
+    write_screening_xlsx(path, frame)
+    return path, len(frame)
+
+def write_shards(work, n, by, jobs, force=False):
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    old = glob.glob(os.path.join(SHARD_DIR, "*.xlsx"))
+    if old and not force:  # they may hold reviewer decisions
+        raise SystemExit(f"{SHARD_DIR} already has {len(old)} workbooks; merge them first or pass --force")
+    for f in old:
+        os.remove(f)  # stale shards from a run with another N would be merged too
+    key = shard_of(work, n, by)
+    paths = [os.path.join(SHARD_DIR, f"TitleAbs_Screening_{k+1:02d}of{n:02d}.xlsx") for k in range(n)]
+    frames = [work[key.eq(k)] for k in range(n)]
+    jobs = min(jobs or os.cpu_count() or 1, n)
+    # each shard is an independent workbook, so they are written in parallel
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for path, rows in pool.map(_write_shard, paths, frames):
+            print(f"Created {path} ({rows} records)")
+
+def _nonblank(s):
+    return s.fillna("").astype(str).str.strip()
+
+def merge_shards(files, db=None):
+    """Join reviewer decisions from shard workbooks back onto the master sheet by study_id.
+
+    A study marked differently in two files (e.g. two reviewers screening the
+    same shard) is a conflict: it is left blank in the merged sheet and listed
+    in screening_conflicts.csv.
+    """
+    if not files:
+        raise SystemExit(f"No shard workbooks found in {SHARD_DIR}")
+    parts = []
+    for f in files:
+        s = pd.read_excel(f, sheet_name="Screening", dtype=str)
+        s = s.reindex(columns=["study_id"] + DECISION_COLS)
+        for c in s.columns: s[c] = _nonblank(s[c])
+        parts.append(s.assign(file=os.path.basename(f)))
+    long = pd.concat(parts, ignore_index=True)
+    decided = long[long[DECISION_COLS].ne("").any(axis=1)]
+
+    # one decision per study_id unless files disagree
+    distinct = decided.drop_duplicates(["study_id"] + DECISION_COLS)
+    n_dec = distinct.groupby("study_id").size()
+    conflict_ids = n_dec.index[n_dec > 1]
+    agreed = distinct[~distinct["study_id"].isin(conflict_ids)].set_index("study_id")[DECISION_COLS]
+
+    if os.path.exists(OUT_XLSX):
+        base = read_sidecar(OUT_XLSX, dtype=str)
+        if base is None: base = pd.read_excel(OUT_XLSX, sheet_name="Screening", dtype=str).fillna("")
+    else:  # no master sheet: the shards together are the table
+        base = pd.concat([pd.read_excel(f, sheet_name="Screening", dtype=str) for f in files]).fillna("")
+        base = base.drop_duplicates("study_id")
+    base = base.copy()
+    for c in DECISION_COLS:
+        if c not in base.columns: base[c] = ""
+        base[c] = base["study_id"].map(agreed[c]).fillna(base[c])
+        base.loc[base["study_id"].isin(conflict_ids), c] = ""  # not whatever the master sheet held
+    unknown = sorted(set(long["study_id"]) - set(base["study_id"]) - {""})
+
+    conflicts = decided[decided["study_id"].isin(conflict_ids)].sort_values(["study_id", "file"])
+    conflicts[["study_id", "file"] + DECISION_COLS].to_csv(CONFLICTS_CSV, index=False)
+    write_screening_xlsx(MERGED_XLSX, base)
+    if db:
+        with closing(bib_store.connect(db)) as con:
+            bib_store.upsert_sheet(con, base)
+            bib_store.update_decisions(con, agreed.index, agreed[DECISION_COLS[0]], agreed[DECISION_COLS[1]])
+    print(f"Merged {len(files)} shard files: {len(agreed)} decided, {len(conflict_ids)} conflicts, "
+          f"{int(base['incl_titleabs_yesno'].eq('').sum())} still blank.")
+    print(f"Created {MERGED_XLSX}")
+    print(f"Created {CONFLICTS_CSV} ({len(conflicts)} rows)")
+    if unknown:
+        print(f"[WARN] {len(unknown)} study_ids in the shards are not in {OUT_XLSX}: {unknown[:5]}", file=sys.stderr)
+
+def main(argv=None, df=None):
+    ap = argparse.ArgumentParser(description="Make (or merge) Title/Abstract screening workbooks")
+    ap.add_argument("--shards", type=int, default=0, help="also split the sheet into N reviewer workbooks")
+    ap.add_argument("--by", choices=["count", "hash"], default="count", help="shard by position or by study_id hash")
+    ap.add_argument("--jobs", type=int, default=0, help="processes for writing shards (0 = all cores)")
+    ap.add_argument("--force", action="store_true", help="replace existing shard workbooks")
+    ap.add_argument("--db", nargs="?", const="", default=None,
+                    help="keep decisions in the SQLite store; a new sheet gets those already made (default path data_clean/bib.sqlite, or $BIB_DB)")
+    ap.add_argument("--merge", nargs="*", metavar="XLSX",
+                    help=f"merge reviewer decisions from shard workbooks (default: {SHARD_DIR}/*.xlsx)")
+    bib_perf.add_args(ap)
+    args = ap.parse_args(argv)
+    os.makedirs("data_clean", exist_ok=True)
+    db = bib_store.db_path(args.db)
+
+    if args.merge is not None:
+        bib_perf.start("screening_merge", args)
+        with step("merge shards"):
+            merge_shards(args.merge or sorted(glob.glob(os.path.join(SHARD_DIR, "*.xlsx"))), db)
+        bib_perf.finish()
+        return
+
+    bib_perf.start("screening_sheet", args)
+    with step("build sheet") as st:
+        work = build_sheet(df)
+        st["rows"] = len(work)
+    if db:
+        # studies screened before (same study_id, or same DOI) keep their decision
+        with closing(bib_store.connect(db)) as con, step("store", rows=len(work)):
+            work = bib_store.upsert_sheet(con, work)
+        print(f"Carried {int(work['incl_titleabs_yesno'].ne('').sum())} decisions over from {db}")
+    # 写 Excel（单次流式写入，含下拉菜单）
+    with step("excel write", rows=len(work)):
+        write_screening_xlsx(OUT_XLSX, work)
+    with step("sidecar", rows=len(work)):
+        write_sidecar(work, OUT_XLSX)
+    print(f"Created {OUT_XLSX}")
+    if args.shards > 0:
+        with step("write shards", rows=len(work)):
+            write_shards(work, args.shards, args.by, args.jobs, args.force)
+    bib_perf.finish(rows_out=len(work))
+    return work
+
+if __name__ == "__main__":
+    main()
@@ -2,32 +2,37 @@
 # -*- coding: utf-8 -*-
 """
 Auto-screen Title/Abstract with heuristic rules and write suggestions.
-Input: data_clean/TitleAbs_Screening.xlsx (preferred) or data_clean/master_refs_raw.csv
+Input: data_clean/TitleAbs_Screening.xlsx (preferred), else data_clean/master_bibliography.csv or master_refs_raw.csv
+Rules: code/autoscreen_rules.json (vocabularies + ordered rules; --rules to override)
 Output: data_clean/TitleAbs_Screening_AUTO.xlsx  (incl_titleabs_yesno / exclusion_reason prefilled where high-confidence)
 """
-import os, re, hashlib, pandas as pd
+import os, re, json, time, hashlib, argparse, pandas as pd
+from collections import defaultdict
+from contextlib import closing
+import bib_perf, bib_store
+from bib_perf import step
+from bib_io import read_csv_any, read_sidecar, write_screening_xlsx, write_sidecar
 
 DATA_DIR = "data_clean"
 SRC_XLSX = os.path.join(DATA_DIR, "TitleAbs_Screening.xlsx")
-SRC_RAW  = os.path.join(DATA_DIR, "master_refs_raw.csv")
+SRC_RAW  = [os.path.join(DATA_DIR, f) for f in ("master_bibliography.csv", "master_refs_raw.csv")]  # first found
 OUT_XLSX = os.path.join(DATA_DIR, "TitleAbs_Screening_AUTO.xlsx")
+CACHE_DIR = os.path.join(DATA_DIR, ".cache", "autoscreen")  # one decisions file per rules version
+RULES_FILE = os.getenv("AUTOSCREEN_RULES",
+                       os.path.join(os.path.dirname(os.path.abspath(__file__)), "autoscreen_rules.json"))
 
 def read_any_csv(path):
-    for enc in ("utf-8", "utf-8-sig", "gb18030", "latin-1"):
-        try:
-            return pd.read_csv(path, dtype=str, encoding=enc).fillna("")
-        except Exception:
-            pass
-    return pd.read_csv(path, dtype=str).fillna("")
+    df = read_sidecar(path, dtype=str)
+    if df is not None: return df
+    return read_csv_any(path, dtype=str).fillna("")
 
-def norm(s):  # lower + remove non-alnum
-    return re.sub(r"[^a-z0-9]+", " ", str(s).lower()).strip()
+def norm(s):  # lower + remove non-alnum (CJK kept, so Chinese keywords can match)
+    return re.sub(r"[^a-z0-9\u3400-\u9fff]+", " ", str(s).lower()).strip()
 
-def first_nonempty(*vals):
-    for v in vals:
-        if isinstance(v,str) and v.strip():
-            return v
-    return ""
+def nonempty_str(s):
+    # vectorized first_nonempty() for one column: non-blank strings, else ""
+    s = s.where(s.map(lambda v: isinstance(v, str)), "")
+    return s.where(s.str.strip().ne(""), "")
 
 def build_from_raw(df):
     cols = {c.lower(): c for c in df.columns}
@@ -52,11 +57,9 @@ def build_from_raw(df):
     if col_url: work["url"] = df[col_url]
 
     # study_id
-    sid = []
-    for _, r in work.iterrows():
-        t = first_nonempty(r.get("title",""))
-        y = first_nonempty(r.get("year",""))
-        sid.append(hashlib.md5((t+"|"+y).encode("utf-8","ignore")).hexdigest()[:12])
+    t = nonempty_str(work["title"])
+    y = nonempty_str(work["year"])
+    sid = [hashlib.md5((a+"|"+b).encode("utf-8","ignore")).hexdigest()[:12] for a, b in zip(t, y)]
     work.insert(0,"study_id",sid)
     work.insert(1,"incl_titleabs_yesno","")
     work.insert(2,"exclusion_reason","")
@@ -64,94 +67,254 @@ def build_from_raw(df):
 
 def load_screening():
     if os.path.exists(SRC_XLSX):
+        df = read_sidecar(SRC_XLSX, dtype=str)  # only while the sheet is unedited since 06 wrote it
+        if df is not None: return df
         return pd.read_excel(SRC_XLSX, sheet_name="Screening").fillna("")
-    elif os.path.exists(SRC_RAW):
-        return build_from_raw(read_any_csv(SRC_RAW))
-    else:
-        raise SystemExit("Missing input: TitleAbs_Screening.xlsx or master_refs_raw.csv")
+    src = next((p for p in SRC_RAW if os.path.exists(p)), None)
+    if src is None:
+        raise SystemExit("Missing input: TitleAbs_Screening.xlsx, master_bibliography.csv or master_refs_raw.csv")
+    return build_from_raw(read_any_csv(src))
 
 # ----- rules -----
-KW_NOT_MS = {"university","college","higher education","undergraduate",
-             "senior high","upper secondary","high school",
-             "primary","elementary","kindergarten","preschool",
-             "vocational","tvet"}
-KW_MS_POS = {"middle school","junior high","lower secondary","初中","初级中学"}
-
-CHINA_POS = {"china","chinese","prc","mainland","beijing","shanghai","guangdong","zhejiang",
-             "jiangsu","shandong","sichuan","hubei","hunan","henan","shenzhen","tianjin","chongqing",
-             "hong kong","macau","guangxi","heilongjiang","liaoning","shanxi","shaanxi"}
-NON_CHINA = {"united states","usa","uk","england","australia","canada","singapore","malaysia",
-             "japan","korea","vietnam","thailand","india","pakistan","iran","turkey","brazil","mexico",
-             "nigeria","ethiopia","spain","france","germany","italy"}
-
-KW_NOT_QUANT = {"qualitative","interview","focus group","ethnograph","phenomenolog","narrative",
-                "grounded theory","discourse analysis","thematic analysis","case study"}
-KW_THEORY = {"conceptual","theoretical","framework","model proposal","literature review","scoping review",
-             "bibliometric","meta-analysis","protocol","editorial","commentary","viewpoint"}
-KW_ACH = {"achievement","test score","exam","gpa","performance","grades","academic"}
-KW_TL  = {"transformational leadership","transformational","mlq","tlq","tfl"}
-
-def any_in(text, vocab): return any(k in text for k in vocab)
-def none_in(text, vocab): return not any_in(text, vocab)
-
-# ----- main -----
-df = load_screening()
-text = (df.get("title","") + " " + df.get("abstract","")).fillna("").map(norm)
-
-# duplicate by DOI or normalized title
-if "doi" in df.columns:
-    dup_mask = df["doi"].str.lower().duplicated(keep="first") & df["doi"].ne("")
-else:
-    dup_mask = df["title"].fillna("").map(norm).duplicated(keep="first")
-
-auto_reason = []
-auto_yesno  = []
-for i, t in enumerate(text):
-    reason = ""
-    # duplicates
-    if dup_mask.iloc[i]:
-        reason = "DUPLICATE_DATASET"
-    # not middle-school (if negative terms exist and no positive ms terms)
-    elif any_in(t, KW_NOT_MS) and none_in(t, KW_MS_POS):
-        reason = "NOT_MIDDLE_SCHOOL"
-    # NOT_CHINA (mentions other countries and no China tokens)
-    elif any_in(t, NON_CHINA) and none_in(t, CHINA_POS):
-        reason = "NOT_CHINA"
-    # purely non-quant
-    elif any_in(t, KW_NOT_QUANT) and none_in(t, {"regression","anova","correlation","structural equation","sem","survey","quantitat"}):
-        reason = "NOT_QUANT"
-    # theory/review etc.
-    elif any_in(t, KW_THEORY):
-        reason = "THEORY_ONLY"
-
-    if reason:
-        auto_reason.append(reason); auto_yesno.append("no"); continue
-
-    # high-confidence include
-    if any_in(t, KW_TL) and any_in(t, KW_ACH) and any_in(t, CHINA_POS|KW_MS_POS):
-        auto_reason.append(""); auto_yesno.append("yes")
+CJK = re.compile(r"[\u3400-\u9fff]")
+
+def _trie_regex(entries):
+    # entries: (term, group, tail).  Common prefixes are factored so each position
+    # is tested once per character; every term ends in an empty named group, so
+    # m.lastgroup says which term matched.
+    trie = {}
+    for term, group, tail in entries:
+        node = trie
+        for ch in term: node = node.setdefault(ch, {})
+        node[""] = (group, tail)
+    def walk(node):
+        alts = [re.escape(ch) + walk(sub) for ch, sub in sorted(node.items()) if ch]
+        if "" in node:
+            alts.append("(?P<{}>){}".format(*node[""]))
+        return alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+    return walk(trie) if trie else "(?!)"
+
+def _tail(term, stem):
+    if CJK.search(term): return ""  # CJK: no word boundaries
+    return r"\w*" if stem else r"(?:e?s)?\b"
+
+def compile_vocabs(vocabs):
+    """Compile {rule: vocab} into one regex for Latin terms and one for CJK terms.
+
+    Returns (latin_rx, cjk_rx, {group: rules}).  A term that contains another
+    rule's term is credited to both, since finditer only reports
+    non-overlapping matches.
+    """
+    owners, tails = defaultdict(set), {}
+    for name, vocab in vocabs.items():
+        for term in vocab:
+            t = norm(term.rstrip("*"))
+            if not t: continue
+            owners[t].add(name)
+            tails[t] = _tail(t, term.endswith("*"))
+    for t in list(owners):
+        for u in list(owners):
+            pre = "" if CJK.search(u) else r"\b"
+            if u != t and re.search(pre + re.escape(u) + tails[u], t):
+                owners[t] |= owners[u]
+    entries = [(t, f"t{k}", tails[t]) for k, t in enumerate(sorted(owners))]
+    latin = _trie_regex([e for e in entries if not CJK.search(e[0])])
+    cjk = _trie_regex([e for e in entries if CJK.search(e[0])])
+    return re.compile(r"\b" + latin), re.compile(cjk), {g: frozenset(owners[t]) for t, g, _ in entries}
+
+def vocab_hits(text, compiled):
+    # names of every vocabulary with at least one term in text (one regex scan)
+    latin, cjk, owners = compiled
+    hits = set()
+    for m in latin.finditer(text):
+        hits |= owners[m.lastgroup]
+    if CJK.search(text):
+        for m in cjk.finditer(text):
+            hits |= owners[m.lastgroup]
+    return hits
+
+def load_rules(path):
+    """Read and compile the rule file; version = hash of its bytes."""
+    raw = open(path, "rb").read()
+    spec = json.loads(raw.decode("utf-8"))
+    vocabs = {name: set(terms) for name, terms in spec["vocabularies"].items()}
+    for r in spec["rules"]:
+        unknown = [v for k in ("all", "any", "none") for v in r.get(k, []) if v not in vocabs]
+        if unknown:
+            raise SystemExit(f"{path}: rule {r.get('name')!r} uses unknown vocabularies {unknown}")
+    t0 = time.perf_counter()
+    matcher = compile_vocabs(vocabs)
+    return {"path": path, "version": hashlib.sha1(raw).hexdigest()[:12], "vocabs": list(vocabs),
+            "rules": spec["rules"], "matcher": matcher, "compile_s": time.perf_counter() - t0}
+
+def rule_fires(rule, hits, is_dup):
+    if "duplicate" in rule and bool(rule["duplicate"]) != is_dup: return False
+    if any(v not in hits for v in rule.get("all", [])): return False
+    if rule.get("any") and not any(v in hits for v in rule["any"]): return False
+    return not any(v in hits for v in rule.get("none", []))
+
+def screen(text, dup_mask, rules):
+    """Apply the ordered rules to each normalized text; first firing rule decides.
+
+    Returns (auto_yesno, auto_reason, stats) with per-vocabulary hit counts and
+    per-rule fire counts / evaluation time.
+    """
+    stats = {"vocab_hits": dict.fromkeys(rules["vocabs"], 0),
+             "rules": {r["name"]: {"checked": 0, "fired": 0, "seconds": 0.0} for r in rules["rules"]}}
+    auto_reason, auto_yesno, scan_s = [], [], 0.0
+    for t, is_dup in zip(text, dup_mask):
+        t0 = time.perf_counter()
+        hits = vocab_hits(t, rules["matcher"])
+        scan_s += time.perf_counter() - t0
+        for v in hits: stats["vocab_hits"][v] += 1
+        yesno = reason = ""
+        for r in rules["rules"]:
+            st = stats["rules"][r["name"]]
+            t0 = time.perf_counter()
+            fired = rule_fires(r, hits, bool(is_dup))
+            st["seconds"] += time.perf_counter() - t0
+            st["checked"] += 1
+            if fired:
+                st["fired"] += 1
+                yesno, reason = r.get("decision", ""), r.get("reason", "")
+                break
+        auto_yesno.append(yesno); auto_reason.append(reason)  # "" = leave for human review
+    stats["scan_s"] = scan_s
+    return auto_yesno, auto_reason, stats
+
+def content_keys(df, dup_mask):
+    # cache key per row: title + abstract as given (norm() is a pure function of
+    # them, so cached rows need no normalizing) + the duplicate flag, which the
+    # rules also see
+    blank = pd.Series("", index=df.index)
+    t = df.get("title", blank).fillna("").astype(str)
+    a = df.get("abstract", blank).fillna("").astype(str)
+    return [hashlib.md5(f"{x}\0{y}\0{int(d)}".encode("utf-8")).hexdigest() for x, y, d in zip(t, a, dup_mask)]
+
+def load_cache(version):
+    path = os.path.join(CACHE_DIR, f"{version}.csv")
+    if not os.path.exists(path): return {}
+    c = pd.read_csv(path, dtype=str, keep_default_na=False)
+    return dict(zip(c["key"], zip(c["yesno"], c["reason"])))
+
+def save_cache(version, cache):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for f in os.listdir(CACHE_DIR):
+        if f != f"{version}.csv": os.remove(os.path.join(CACHE_DIR, f))  # other rule versions are dead
+    pd.DataFrame([(k, y, r) for k, (y, r) in cache.items()], columns=["key", "yesno", "reason"]) \
+        .to_csv(os.path.join(CACHE_DIR, f"{version}.csv"), index=False)
+
+def print_stats(rules, stats, n):
+    print(f"[RULES] {rules['path']} v{rules['version']}: {len(rules['vocabs'])} vocabularies, "
+          f"{len(rules['rules'])} rules, compiled in {rules['compile_s']:.3f}s")
+    print(f"[TIME] scan {stats['scan_s']:.2f}s for {n} records")
+    for v, c in sorted(stats["vocab_hits"].items(), key=lambda x: -x[1]):
+        print(f"[VOCAB] {v:<14} {c:7d} records")
+    for name, st in stats["rules"].items():
+        print(f"[RULE] {name:<18} fired {st['fired']:6d} / checked {st['checked']:6d}  {st['seconds']:.3f}s")
+
+def write_workbook(df, auto_yesno, auto_reason):
+    out = df.copy()
+    if "incl_titleabs_yesno" not in out.columns: out.insert(1,"incl_titleabs_yesno","")
+    if "exclusion_reason" not in out.columns: out.insert(2,"exclusion_reason","")
+    # 仅在空白处填入建议，不覆盖人工决定
+    out["incl_titleabs_yesno"] = out["incl_titleabs_yesno"].mask(out["incl_titleabs_yesno"].eq(""), auto_yesno)
+    out["exclusion_reason"]    = out["exclusion_reason"].mask(out["exclusion_reason"].eq(""), auto_reason)
+    # 打标签辅助
+    out["auto_flag"] = ["AUTO" if y or r else "" for y,r in zip(auto_yesno,auto_reason)]
+
+    # 输出（单次流式写入，下拉菜单与 06 相同）
+    write_screening_xlsx(OUT_XLSX, out)
+    write_sidecar(out, OUT_XLSX)
+    return out
+
+def main(argv=None, df=None):
+    # df: the screening sheet already in memory (run_pipeline.py); returns the AUTO sheet if written
+    ap = argparse.ArgumentParser(description="Auto-screen titles/abstracts with rule-file heuristics")
+    ap.add_argument("--rules", default=RULES_FILE, help="rule file (JSON)")
+    ap.add_argument("--dry-run", action="store_true", help="print rule statistics only, don't write the workbook")
+    ap.add_argument("--watch", action="store_true", help="re-run whenever the rule file changes (Ctrl-C to stop)")
+    ap.add_argument("--db", nargs="?", const="", default=None,
+                    help="write decisions/suggestions to the SQLite store by study_id (default path data_clean/bib.sqlite, or $BIB_DB)")
+    ap.add_argument("--no-xlsx", action="store_true", help="with --db: only update the store, skip the workbook")
+    ap.add_argument("--no-cache", action="store_true", help="re-evaluate every row, ignore data_clean/.cache/autoscreen")
+    bib_perf.add_args(ap)
+    args = ap.parse_args(argv)
+    db = bib_store.db_path(args.db)
+
+    bib_perf.start("autoscreen", args)
+    with step("load") as st:
+        if df is None: df = load_screening()
+        st["rows"] = len(df)
+    raw = (df.get("title","") + " " + df.get("abstract","")).fillna("")
+
+    # duplicate by DOI or normalized title
+    if "doi" in df.columns:
+        dup_mask = df["doi"].str.lower().duplicated(keep="first") & df["doi"].ne("")
     else:
-        auto_reason.append(""); auto_yesno.append("")  # leave for human review
-
-# write suggestions
-out = df.copy()
-if "incl_titleabs_yesno" not in out.columns: out.insert(1,"incl_titleabs_yesno","")
-if "exclusion_reason" not in out.columns: out.insert(2,"exclusion_reason","")
-# 仅在空白处填入建议，不覆盖人工决定
-out["incl_titleabs_yesno"] = out["incl_titleabs_yesno"].mask(out["incl_titleabs_yesno"].eq(""), auto_yesno)
-out["exclusion_reason"]    = out["exclusion_reason"].mask(out["exclusion_reason"].eq(""), auto_reason)
-# 打标签辅助
-out["auto_flag"] = ["AUTO" if y or r else "" for y,r in zip(auto_yesno,auto_reason)]
-
-# 输出
-with pd.ExcelWriter(OUT_XLSX, engine="openpyxl") as w:
-    out.to_excel(w, index=False, sheet_name="Screening")
-    pd.DataFrame({"YesNo":["yes","no"]}).to_excel(w, index=False, sheet_name="YesNo")
-    pd.DataFrame({"Allowed_Values":["NOT_MIDDLE_SCHOOL","NOT_CHINA","NOT_QUANT","NO_EFFECT_SIZE",
-                                     "DUPLICATE_DATASET","THEORY_ONLY","OTHER"]}).to_excel(w, index=False, sheet_name="Dictionary")
-
-# 简报
-print("Autoscreen done.")
-print("Suggested NO:", sum([x=='no' for x in auto_yesno]))
-print("Suggested YES:", sum([x=='yes' for x in auto_yesno]))
-print("Total blank (needs human):", sum([x=='' for x in auto_yesno]))
+        dup_mask = df["title"].fillna("").map(norm).duplicated(keep="first")
+
+    # rows a human already decided are never re-screened (their suggestion would not be used)
+    blank = pd.Series("", index=df.index)
+    human = (df.get("incl_titleabs_yesno", blank).ne("") | df.get("exclusion_reason", blank).ne("")).to_numpy()
+    with step("content keys", rows=len(df)):
+        keys = content_keys(df, dup_mask)
+    normed = {}  # row -> norm(text), kept across --watch reloads
+
+    mtime, out = None, None
+    while True:
+        mtime = os.path.getmtime(args.rules)
+        if not bib_perf.active(): bib_perf.start("autoscreen", args)  # next --watch round
+        with step("load rules"):
+            rules = load_rules(args.rules)
+        cache = {} if args.no_cache else load_cache(rules["version"])
+        todo = [k for k in range(len(df)) if not human[k] and keys[k] not in cache]
+        t0 = time.perf_counter()
+        with step("normalize", rows=len(todo)):
+            for k in todo:
+                if k not in normed: normed[k] = norm(raw.iat[k])
+        norm_s = time.perf_counter() - t0
+        with step("rule eval", rows=len(todo)):
+            got_yesno, got_reason, stats = screen([normed[k] for k in todo], dup_mask.iloc[todo], rules)
+        for k, y, r in zip(todo, got_yesno, got_reason):
+            cache[keys[k]] = (y, r)
+        auto_yesno = ["" if human[k] else cache[keys[k]][0] for k in range(len(df))]
+        auto_reason = ["" if human[k] else cache[keys[k]][1] for k in range(len(df))]
+        print(f"[TIME] normalize {norm_s:.2f}s for {len(todo)} records")
+        print_stats(rules, stats, len(todo))
+        if not args.dry_run and not args.no_cache:
+            save_cache(rules["version"], {keys[k]: cache[keys[k]] for k in range(len(df)) if not human[k]})
+        if not args.dry_run and db:
+            # only the decision columns change; rows are added for new study_ids only
+            with closing(bib_store.connect(db)) as con, step("store", rows=len(df)):
+                bib_store.upsert_sheet(con, df, refresh=False)
+                decided = df[df["incl_titleabs_yesno"].ne("")]
+                bib_store.update_decisions(con, decided["study_id"], decided["incl_titleabs_yesno"],
+                                           decided["exclusion_reason"])
+                n = bib_store.update_decisions(con, df["study_id"], auto_yesno, auto_reason,
+                                               auto=True, version=rules["version"])
+            print(f"[DB] {n} suggestions written to {db}")
+        if not args.dry_run and not (db and args.no_xlsx):
+            with step("excel write", rows=len(df)):
+                out = write_workbook(df, auto_yesno, auto_reason)
+
+        # 简报
+        print("Autoscreen done." if not args.dry_run else "Autoscreen dry run (no workbook written).")
+        print("Suggested NO:", sum([x=='no' for x in auto_yesno]))
+        print("Suggested YES:", sum([x=='yes' for x in auto_yesno]))
+        print("Total blank (needs human):", sum([x=='' and not h for x, h in zip(auto_yesno, human)]))
+        print(f"Rows: {len(todo)} evaluated, {len(df) - len(todo) - int(human.sum())} from cache, "
+              f"{int(human.sum())} already decided by a human (skipped)")
+        bib_perf.finish(rows_in=len(df), evaluated=len(todo), cached=len(df) - len(todo) - int(human.sum()),
+                        human=int(human.sum()), rules_version=rules["version"],
+                        rule_fired={n: r["fired"] for n, r in stats["rules"].items()})
+        if not args.watch: return out
+        print(f"[WATCH] waiting for changes to {args.rules} ...")
+        try:
+            while os.path.getmtime(args.rules) == mtime:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            return out
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Build the clean CSV for Rayyan upload from the (auto-)screening sheet
+#   python code/08_make_rayyan_csv.py   -> data_clean/rayyan_upload_v1.csv
+# (was an inline script in .github/workflows/make_rayyan_csv.yml)
+
+import os, re, sys, argparse, pandas as pd
+from bib_io import read_sidecar
+
+CANDIDATES = [
+    "data_clean/TitleAbs_Screening_AUTO.xlsx",
+    "data_clean/TitleAbs_Screening.xlsx",
+    "data_clean/TitleAbs_Screening_AUTO.csv",
+    "data_clean/master_bibliography.csv",
+    "data_clean/master_refs_raw.csv",
+]
+OUT_CSV = "data_clean/rayyan_upload_v1.csv"
+KEEP = ["study_id", "title", "abstract", "authors", "year"]
+MAX_CELL = 50000
+
+def load_source():
+    src = next((p for p in CANDIDATES if os.path.exists(p)), None)
+    if not src:
+        print("ERROR: no input file found. Tried:", CANDIDATES, file=sys.stderr)
+        sys.exit(1)
+    print("Reading:", src)
+    df = read_sidecar(src, dtype=str)  # typed copy written by 06/07, if still current
+    if df is not None: return df
+    if src.endswith(".xlsx"):
+        return pd.read_excel(src)
+    return pd.read_csv(src)
+
+def clean(s):
+    if pd.isna(s): return ""
+    s = str(s).replace("\r", " ").replace("\n", " ").replace("\t", " ")
+    return re.sub(" +", " ", s).strip()[:MAX_CELL]
+
+def build_rayyan(df):
+    cols = [c for c in KEEP if c in df.columns]
+    if not cols:
+        print("ERROR: none of expected columns present:", KEEP, file=sys.stderr)
+        print("Columns in file:", df.columns.tolist(), file=sys.stderr)
+        sys.exit(1)
+    df = df.loc[:, cols].copy()
+    for c in df.columns:
+        df[c] = df[c].map(clean)
+    return df
+
+def main(argv=None, df=None):
+    # df: the AUTO sheet already in memory (run_pipeline.py)
+    ap = argparse.ArgumentParser(description="Write data_clean/rayyan_upload_v1.csv for Rayyan")
+    ap.parse_args(argv)
+    out = build_rayyan(load_source() if df is None else df)
+    os.makedirs("data_clean", exist_ok=True)
+    out.to_csv(OUT_CSV, index=False, encoding="utf-8")
+    print("OK Wrote", OUT_CSV, out.shape)
+    return out
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+# bench_pipeline.py
+# Synthetic-corpus benchmark for merge_bibliography -> dedupe_bibliography -> 07_autoscreen.
+#   python code/bench_pipeline.py                                  -> 1k, 10k, 100k records
+#   python code/bench_pipeline.py --sizes 1k 10k 100k 1m --repeat 3
+# Every size runs in its own sandbox bench/<size>/ (a copy of code/, a generated
+# data_raw/ and its own data_clean/), so the real data_clean is never touched.
+# Corpora are seeded: the same --seed and rates give byte-identical files, and a
+# corpus is only regenerated when those change.
+# Output (in --out, default bench/):
+#   results.csv  one row per size x stage x repeat (seconds, rows/s, peak RSS, dedupe accuracy)
+#   steps.csv    the per-step timings from each stage's run report (bib_perf)
+#   curves.csv   median seconds, throughput and peak RSS per stage vs corpus size
+#   curves.png   the same as plots, when matplotlib is installed
+
+import os, re, csv, sys, json, random, shutil, argparse, subprocess, time
+from pathlib import Path
+import pandas as pd
+
+BASE = Path(__file__).resolve().parents[1]
+CODE = Path(__file__).resolve().parent
+BENCH_DIR = BASE / "bench"
+STAGES = [  # (report stage name, script, extra args)
+    ("merge", "merge_bibliography.py", ["--no-cache"]),
+    ("dedupe", "dedupe_bibliography.py", []),
+    ("autoscreen", "07_autoscreen.py", ["--no-cache"]),
+]
+GEN_VERSION = "2"  # bump when the generator changes, forces new corpora
+
+# ---- vocabulary ------------------------------------------------------------
+# random word sequences, so two distinct works are far below the dedupe cut-off;
+# the topic phrases come from autoscreen_rules.json, so every rule gets to fire
+EN_WORDS = """
+school principal teacher student learning leadership effect role impact influence relationship
+evidence analysis study survey data model mediating moderating outcome achievement performance
+collective efficacy trust climate culture commitment motivation engagement satisfaction support
+instructional distributed shared servant ethical authentic practice reform policy accountability
+district county urban rural region provincial national longitudinal multilevel hierarchical
+approach perspective examination investigation assessment measurement validation development
+professional community collaboration innovation change improvement quality equity gap family
+socioeconomic background parental involvement homework mathematics reading science literacy
+cognitive emotional social wellbeing burnout stress retention turnover workload autonomy
+decision making vision goal setting feedback evaluation mentoring coaching training capacity
+organizational structural cultural contextual comparative cross sectional panel cohort sample
+""".split()
+EN_TOPICS = ["transformational leadership", "student achievement", "academic performance", "test scores",
+             "middle school", "junior high", "lower secondary", "high school", "primary school", "university",
+             "China", "Chinese", "Shanghai", "Guangdong", "Hong Kong", "United States", "Australia", "Malaysia",
+             "regression", "structural equation modeling", "survey", "quantitative", "qualitative", "interview",
+             "case study", "literature review", "meta-analysis", "conceptual framework"]
+EN_JOURNALS = ["Educational Administration Quarterly", "School Leadership & Management",
+               "Journal of Educational Administration", "Asia Pacific Education Review",
+               "Leadership and Policy in Schools", "Educational Management Administration & Leadership",
+               "International Journal of Educational Research", "SAGE Open", "Frontiers in Psychology"]
+CN_WORDS = """
+校长 教师 学生 学校 领导 影响 作用 关系 研究 分析 机制 路径 效能 信任 氛围 文化 承诺 动机 投入 满意度
+支持 教学 分布式 道德 实践 改革 政策 问责 区域 县域 城乡 农村 省级 追踪 多层 中介 调节 效应 评价 测量
+发展 专业 共同体 合作 创新 变革 改进 质量 公平 差距 家庭 背景 家长 参与 作业 数学 阅读 科学 素养 认知
+情绪 社会 幸福感 倦怠 压力 流失 负担 自主 决策 愿景 目标 反馈 指导 培训 能力 组织 结构 比较 样本 实证
+""".split()
+CN_TOPICS = ["变革型领导", "学业成绩", "学业成就", "初中", "初级中学", "高中", "小学", "大学", "问卷调查",
+             "回归分析", "结构方程模型", "质性研究", "访谈", "个案研究", "文献综述", "理论框架"]
+CN_JOURNALS = ["基础教育研究", "教育研究", "中国教育学刊", "教育发展研究", "全球教育展望", "中小学管理",
+               "教师教育研究", "华东师范大学学报(教育科学版)"]
+SURNAMES = ["Wang", "Li", "Zhang", "Liu", "Chen", "Yang", "Huang", "Zhao", "Wu", "Zhou", "Smith", "Leithwood",
+            "Hallinger", "Bush", "Day", "Harris", "Jones", "Brown", "Garcia", "Nguyen", "Kim", "Tan"]
+CN_NAMES = list("王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗")
+CN_GIVEN = list("伟芳娜敏静丽强磊军洋勇艳杰涛明超秀霞平刚")
+
+def parse_size(s):
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([km]?)", s.strip().lower())
+    if not m: raise argparse.ArgumentTypeError(f"bad size {s!r} (use e.g. 1000, 10k, 1m)")
+    return int(float(m.group(1)) * {"": 1, "k": 1_000, "m": 1_000_000}[m.group(2)])
+
+def size_label(n):
+    if n % 1_000_000 == 0: return f"{n // 1_000_000}m"
+    if n % 1_000 == 0: return f"{n // 1_000}k"
+    return str(n)
+
+# ---- corpus generator ------------------------------------------------------
+def _en_title(rnd):
+    words = rnd.sample(EN_WORDS, rnd.randint(6, 11)) + rnd.sample(EN_TOPICS, rnd.randint(1, 2))
+    rnd.shuffle(words)
+    t = " ".join(words)
+    return t[0].upper() + t[1:]
+
+def _cn_title(rnd):
+    words = rnd.sample(CN_WORDS, rnd.randint(6, 10)) + rnd.sample(CN_TOPICS, rnd.randint(1, 2))
+    rnd.shuffle(words)
+    return "".join(words)
+
+def _abstract(rnd, cn):
+    out = []
+    for _ in range(rnd.randint(3, 7)):
+        words = rnd.sample(CN_WORDS if cn else EN_WORDS, rnd.randint(8, 16))
+        words += rnd.sample(CN_TOPICS if cn else EN_TOPICS, rnd.randint(0, 2))
+        rnd.shuffle(words)
+        out.append("".join(words) + "。" if cn else " ".join(words).capitalize() + ".")
+    return ("" if cn else " ").join(out)
+
+def _authors(rnd, cn):
+    if cn:
+        return [rnd.choice(CN_NAMES) + "".join(rnd.sample(CN_GIVEN, rnd.randint(1, 2))) for _ in range(rnd.randint(1, 4))]
+    return [f"{rnd.choice(SURNAMES)}, {rnd.choice('ABCDEFGHJKLMNPRSTWXY')}." for _ in range(rnd.randint(1, 5))]
+
+def make_work(rnd, wid, cn_rate, doi_rate):
+    cn = rnd.random() < cn_rate
+    first = rnd.randint(1, 900)
+    return {"wid": wid, "cn": cn, "title": _cn_title(rnd) if cn else _en_title(rnd),
+            "authors": _authors(rnd, cn), "year": rnd.randint(2000, 2024),
+            "journal": rnd.choice(CN_JOURNALS if cn else EN_JOURNALS),
+            "doi": f"10.{rnd.randint(1000, 9999)}/bench.{wid:08d}" if rnd.random() < doi_rate else "",
+            "abstract": _abstract(rnd, cn),
+            "keywords": rnd.sample(CN_TOPICS if cn else EN_TOPICS, 3),
+            "issn": f"{rnd.randint(1000, 9999)}-{rnd.randint(1000, 9999)}", "issue": 1 + wid % 12,
+            "pages": f"{first}-{first + rnd.randint(4, 30)}"}
+
+def _near_title(rnd, t):
+    # one small edit: typo, dropped word/character, or trailing punctuation
+    kind = rnd.randrange(3)
+    if kind == 0 and len(t) > 3:
+        k = rnd.randrange(1, len(t) - 2)
+        return t[:k] + t[k+1] + t[k] + t[k+2:]
+    if kind == 1:
+        if " " in t:
+            words = t.split(" ")
+            del words[rnd.randrange(1, len(words))]
+            return " ".join(words)
+        k = rnd.randrange(len(t))
+        return t[:k] + t[k+1:]
+    return t + rnd.choice([".", " :", "?", "。"])
+
+def doi_copy(rnd, w):
+    # same DOI as exported by another database: other formatting, maybe no abstract
+    d = dict(w, kind="doi_dup")
+    d["doi"] = rnd.choice([w["doi"], w["doi"].upper(), "https://doi.org/" + w["doi"], "DOI: " + w["doi"]])
+    d["title"] = w["title"].upper() if not w["cn"] and rnd.random() < 0.3 else w["title"]
+    if rnd.random() < 0.5: d["abstract"] = ""
+    return d
+
+def near_copy(rnd, w):
+    # no DOI on either side: only the fuzzy title pass (year +-1) can catch it
+    d = dict(w, kind="near_dup", title=_near_title(rnd, w["title"]), year=w["year"] + rnd.choice([-1, 0, 1]))
+    if rnd.random() < 0.3: d["abstract"] = ""
+    return d
+
+def generate(n, cn_rate=0.3, doi_dup=0.15, near_dup=0.10, doi_rate=0.6, seed=42):
+    """n records: unique works, plus DOI duplicates and near-duplicate titles at the given rates."""
+    rnd = random.Random(seed)
+    n_doi, n_near = int(n * doi_dup), int(n * near_dup)
+    works = [make_work(rnd, k, cn_rate, doi_rate) for k in range(n - n_doi - n_near)]
+    with_doi = [w for w in works if w["doi"]]
+    without = [w for w in works if not w["doi"]]
+    recs = [dict(w, kind="original") for w in works]
+    recs += [doi_copy(rnd, rnd.choice(with_doi)) for _ in range(n_doi if with_doi else 0)]
+    recs += [near_copy(rnd, rnd.choice(without)) for _ in range(n_near if without else 0)]
+    rnd.shuffle(recs)
+    return recs, len(works)
+
+def _url(r):
+    return f"https://bench.invalid/work/{r['wid']}"  # ground truth, survives merge untouched
+
+def write_ris(path, recs):
+    with open(path, "w", encoding="utf-8-sig", newline="\n") as f:
+        for r in recs:
+            f.write("TY  - JOUR\n")
+            for a in r["authors"]: f.write(f"AU  - {a}\n")
+            f.write(f"TI  - {r['title']}\nPY  - {r['year']}\nT2  - {r['journal']}\n")
+            if r["doi"]: f.write(f"DO  - {r['doi']}\n")
+            f.write(f"UR  - {_url(r)}\n")
+            if r["abstract"]: f.write(f"AB  - {r['abstract']}\n")
+            for k in r["keywords"]: f.write(f"KW  - {k}\n")
+            sp, ep = r["pages"].split("-")
+            f.write(f"SN  - {r['issn']}\nIS  - {r['issue']}\nSP  - {sp}\nEP  - {ep}\nER  - \n\n")
+
+def write_refworks(path, recs):
+    # CNKI export dialect (RT/A1/T1/YR ...), authors and keywords ";"-joined
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        for r in recs:
+            f.write(f"RT Journal Article\nSR 1\nA1 {';'.join(r['authors'])};\nT1 {r['title']}\nJF {r['journal']}\n"
+                    f"YR {r['year']}\nK1 {';'.join(r['keywords'])}\n")
+            if r["abstract"]: f.write(f"AB {r['abstract']}\n")
+            if r["doi"]: f.write(f"DO {r['doi']}\n")
+            f.write(f"IS {r['issue']:02d}\nOP {r['pages']}\nSN {r['issn']}\nUL {_url(r)}\nDS CNKI\n\n")
+
+def write_scholar_csv(path, recs, encoding):
+    with open(path, "w", encoding=encoding, newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["Authors", "Title", "Publication", "Pages", "Year", "DOI", "Abstract", "Link"])
+        for r in recs:
+            w.writerow(["; ".join(r["authors"]) + "; ", r["title"], r["journal"], r["pages"], r["year"], r["doi"],
+                        r["abstract"], _url(r)])
+
+def write_corpus(raw, recs, per_file):
+    """Spread records over database-like exports: RIS (English), CNKI RefWorks (Chinese), Scholar CSV (both)."""
+    for sub in ("ris", "csv"):
+        shutil.rmtree(raw / sub, ignore_errors=True)
+        (raw / sub).mkdir(parents=True)
+    rnd = random.Random(len(recs))
+    by_src = {"ris": [], "cnki": [], "csv": []}
+    for r in recs:
+        by_src["csv" if rnd.random() < 0.25 else "cnki" if r["cn"] else "ris"].append(r)
+    for src, rows in by_src.items():
+        for k in range(0, len(rows), per_file):
+            part, name = rows[k:k+per_file], f"bench_{src}_{k // per_file + 1:04d}"
+            if src == "ris": write_ris(raw / "ris" / f"{name}.ris", part)
+            elif src == "cnki": write_refworks(raw / "ris" / f"{name}.ris", part)
+            else:  # every other Scholar file in GB18030, like exports saved by Excel on a Chinese locale
+                write_scholar_csv(raw / "csv" / f"{name}.csv", part, "gb18030" if (k // per_file) % 2 else "utf-8-sig")
+
+def ensure_corpus(box, n, args):
+    """Generate box/data_raw unless the one there was made with the same parameters."""
+    raw = box / "data_raw"
+    params = {"gen": GEN_VERSION, "records": n, "seed": args.seed, "cn_rate": args.cn_rate,
+              "doi_dup": args.doi_dup, "near_dup": args.near_dup, "per_file": args.per_file}
+    meta = raw / "corpus.json"
+    try:
+        have = json.loads(meta.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        have = {}
+    if {k: have.get(k) for k in params} == params:
+        return have
+    t0 = time.perf_counter()
+    recs, n_works = generate(n, args.cn_rate, args.doi_dup, args.near_dup, seed=args.seed)
+    write_corpus(raw, recs, args.per_file)
+    kinds = pd.Series([r["kind"] for r in recs]).value_counts().to_dict()
+    info = {**params, "works": n_works, "kinds": kinds, "chinese": sum(r["cn"] for r in recs)}
+    meta.write_text(json.dumps(info, indent=1), encoding="utf-8")
+    print(f"[OK] Generated {n} records ({n_works} works, {kinds}) in {time.perf_counter()-t0:.1f}s -> {raw}")
+    return info
+
+# ---- runs ------------------------------------------------------------------
+def make_sandbox(box):
+    # the scripts find data_raw/data_clean relative to their own file (or the cwd)
+    shutil.rmtree(box / "code", ignore_errors=True)
+    shutil.copytree(CODE, box / "code", ignore=shutil.ignore_patterns("__pycache__", "bench_pipeline.py"))
+    shutil.rmtree(box / "data_clean", ignore_errors=True)
+    (box / "data_clean").mkdir(parents=True)
+
+def run_stage(box, script, extra, report, log):
+    env = dict(os.environ, BIB_DB="", BIB_PROFILE="")  # time the stages alone
+    t0 = time.perf_counter()
+    with open(log, "a", encoding="utf-8") as out:
+        p = subprocess.run([sys.executable, str(box / "code" / script), "--report", str(report), *extra],
+                           cwd=box, env=env, stdout=out, stderr=subprocess.STDOUT)
+    if p.returncode:
+        raise SystemExit(f"{script} failed (exit {p.returncode}), see {log}")
+    return time.perf_counter() - t0
+
+def dedupe_accuracy(box, info):
+    # each record's URL names its work: kept rows should be exactly one per work
+    master = pd.read_csv(box / "data_clean" / "master_bibliography.csv", usecols=["url"], dtype=str)
+    works = master["url"].str.extract(r"/work/(\d+)$", expand=False)
+    kept_works = works.nunique()
+    return {"expected_kept": info["works"], "kept": len(master),
+            "missed_dups": len(master) - kept_works,       # copies of a work that survived
+            "lost_works": info["works"] - kept_works}      # works merged into another
+
+def bench_size(n, args, results, steps):
+    box = args.out / size_label(n)
+    info = ensure_corpus(box, n, args)
+    for rep in range(1, args.repeat + 1):
+        make_sandbox(box)
+        report, log = box / "data_clean" / "run_report.json", box / "run.log"
+        log.unlink(missing_ok=True)
+        for stage, script, extra in STAGES:
+            if stage == "autoscreen":
+                # no screening sheet in the sandbox: 07 screens master_bibliography itself
+                extra = extra + ([] if args.xlsx else ["--dry-run"])
+            wall = run_stage(box, script, extra, report, log)
+            entry = json.loads(report.read_text(encoding="utf-8"))["stages"][stage]
+            rows = entry.get("rows_in") or n
+            row = {"records": n, "repeat": rep, "stage": stage, "rows": rows, "seconds": entry["seconds"],
+                   "wall_s": round(wall, 3), "rows_per_s": round(rows / max(entry["seconds"], 1e-9)),
+                   "peak_rss_mb": entry.get("peak_rss_mb")}
+            if stage == "dedupe": row.update(dedupe_accuracy(box, info))
+            results.append(row)
+            steps.extend({"records": n, "repeat": rep, "stage": stage, **{k: s.get(k) for k in
+                          ("name", "depth", "seconds", "rows", "peak_rss_mb")}} for s in entry["steps"])
+            print(f"[TIME] {size_label(n):>5} {stage:<10} {entry['seconds']:8.2f}s  "
+                  f"{row['rows_per_s']:>9,} rows/s  peak {row['peak_rss_mb']} MB")
+        acc = next(r for r in reversed(results) if r["stage"] == "dedupe")
+        print(f"[OK] {size_label(n)} dedupe kept {acc['kept']} of {acc['expected_kept']} works "
+              f"({acc['missed_dups']} duplicates missed, {acc['lost_works']} works over-merged)")
+
+def write_curves(out, results):
+    df = pd.DataFrame(results)
+    curves = (df.groupby(["stage", "records"], sort=False)
+                .agg(seconds=("seconds", "median"), rows_per_s=("rows_per_s", "median"),
+                     peak_rss_mb=("peak_rss_mb", "max"), runs=("repeat", "size"))
+                .reset_index().sort_values(["stage", "records"]))
+    curves.to_csv(out / "curves.csv", index=False)
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("[WARN] matplotlib not installed, skipping curves.png (curves.csv has the same data)")
+        return curves
+    fig, axes = plt.subplots(1, 3, figsize=(15, 4.5))
+    for stage, g in curves.groupby("stage"):
+        for ax, col in zip(axes, ("seconds", "rows_per_s", "peak_rss_mb")):
+            ax.plot(g["records"], g[col], marker="o", label=stage)
+    for ax, title in zip(axes, ("wall time (s)", "throughput (rows/s)", "peak RSS (MB)")):
+        ax.set_xscale("log"); ax.set_xlabel("records"); ax.set_title(title); ax.grid(alpha=0.3)
+    axes[0].set_yscale("log"); axes[0].legend()
+    fig.tight_layout(); fig.savefig(out / "curves.png", dpi=120)
+    print(f"[OK] Wrote {out / 'curves.png'}")
+    return curves
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark merge/dedupe/autoscreen on synthetic corpora")
+    ap.add_argument("--sizes", nargs="+", type=parse_size, default=[1_000, 10_000, 100_000],
+                    help="corpus sizes in records, e.g. 1k 10k 100k 1m (default 1k 10k 100k)")
+    ap.add_argument("--repeat", type=int, default=1, help="runs per size (curves use the median)")
+    ap.add_argument("--out", type=Path, default=BENCH_DIR, help="sandboxes and results (default bench/)")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--cn-rate", type=float, default=0.3, help="share of Chinese-language works")
+    ap.add_argument("--doi-dup", type=float, default=0.15, help="share of records that repeat a DOI")
+    ap.add_argument("--near-dup", type=float, default=0.10,
+                    help="share of records that are no-DOI near-duplicate titles (year +-1)")
+    ap.add_argument("--per-file", type=int, default=2000, help="records per generated export file")
+    ap.add_argument("--xlsx", action="store_true", help="let autoscreen write its workbook too (slow at 1m)")
+    args = ap.parse_args(argv)
+    args.out.mkdir(parents=True, exist_ok=True)
+
+    results, steps = [], []
+    for n in sorted(set(args.sizes)):
+        bench_size(n, args, results, steps)
+    pd.DataFrame(results).to_csv(args.out / "results.csv", index=False)
+    pd.DataFrame(steps).to_csv(args.out / "steps.csv", index=False)
+    curves = write_curves(args.out, results)
+    print(curves.to_string(index=False))
+    print(f"[OK] Wrote {args.out / 'results.csv'}, {args.out / 'steps.csv'}, {args.out / 'curves.csv'}")
+
+if __name__ == "__main__":
+    main()
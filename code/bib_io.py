@@ -0,0 +1,319 @@
+# bib_io.py
+# Parquet sidecars for the pipeline's intermediate tables.
+# Each stage still writes its CSV/XLSX for humans and Rayyan. With pyarrow
+# installed it also writes <name>.parquet next to it, with typed columns (year,
+# rec_id as nullable ints), and the next stage loads that instead of re-parsing
+# text. A sidecar records the size and mtime of the file it mirrors and is only
+# used while that file is unchanged, so hand edits to a sheet always win.
+# BIB_PARQUET=0 turns sidecars off.
+#
+# Also home of read_csv_any(), the shared CSV loader for exports of unknown
+# encoding (GB18030 from CNKI, UTF-8 with/without BOM, latin-1).
+# python code/bib_io.py --bench times it against the old try-each-encoding loop.
+#
+# And of write_screening_xlsx(), the one-pass writer for the screening
+# workbooks (06, 07); --bench-xlsx N compares it with the old
+# ExcelWriter + load_workbook + save path.
+
+import os, re, time, codecs, argparse, tempfile
+from pathlib import Path
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency
+    pa = pq = None
+
+ENABLED = pq is not None and os.getenv("BIB_PARQUET", "1") != "0"
+ENCODINGS = ("utf-8", "gb18030", "latin-1")  # fallback order; latin-1 decodes anything
+SNIFF_BYTES = 1 << 20
+INT_COLS = ("year", "rec_id")  # stored as Int64 when every non-blank value is a whole number
+STAMP_KEY = b"bib_io.source"
+EXCLUSION_REASONS = ["NOT_MIDDLE_SCHOOL", "NOT_CHINA", "NOT_QUANT", "NO_EFFECT_SIZE",
+                     "DUPLICATE_DATASET", "THEORY_ONLY", "OTHER"]
+
+def sidecar_path(path):
+    return Path(path).with_suffix(".parquet")
+
+def _stamp(path):
+    st = os.stat(path)
+    return f"{st.st_size}:{st.st_mtime_ns}".encode()
+
+def _typed(df):
+    out = pd.DataFrame(index=df.index)
+    for c in df.columns:
+        s = df[c]
+        if c in INT_COLS:
+            blank = s.isna() | s.astype(str).str.strip().eq("")
+            num = pd.to_numeric(s.where(~blank), errors="coerce")
+            # text must already be integral ("2019", not "2019.0") and floats stay floats,
+            # so as_text() gives back what the CSV holds
+            text_ok = pd.api.types.is_integer_dtype(s) or \
+                (s.dtype == object and s[~blank].astype(str).str.fullmatch(r"\s*-?\d+\s*").all())
+            if text_ok and num[~blank].notna().all() and (num.dropna() % 1 == 0).all():
+                out[c] = num.astype("Int64"); continue
+        if s.dtype == object:  # mixed cells -> strings, blanks/NaN -> null
+            s = s.where(s.isna(), s.astype(str))
+        out[c] = s
+    return out
+
+def write_sidecar(df, path):
+    """Write the Parquet copy of df for the CSV/XLSX just written at path."""
+    if not ENABLED: return None
+    table = pa.Table.from_pandas(_typed(df), preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), STAMP_KEY: _stamp(path)})
+    side = sidecar_path(path)
+    tmp = side.with_name(side.name + ".tmp")
+    pq.write_table(table, tmp)
+    os.replace(tmp, side)
+    return side
+
+class SidecarWriter:
+    """Write path's sidecar a chunk at a time, while path itself is being written.
+
+    Chunks are frames of one table in order (e.g. read_csv(dtype=str) blocks);
+    the first one fixes the column types. A chunk that does not fit them (a
+    non-numeric year after integral ones) drops the sidecar, so readers fall back
+    to the text file. close() stamps the sidecar with path's size and mtime, so
+    call it once path is complete.
+    """
+    def __init__(self, path):
+        self.path, self.side = Path(path), sidecar_path(path)
+        self.tmp = self.side.with_name(self.side.name + ".tmp")
+        self.writer, self.schema = None, None
+        self.ok = ENABLED
+
+    def write(self, df):
+        if not self.ok: return
+        try:
+            table = pa.Table.from_pandas(_typed(df), preserve_index=False)
+            if self.writer is None:
+                # an all-blank column in the first chunk is text, not null
+                self.schema = pa.schema([f.with_type(pa.string()) if pa.types.is_null(f.type) else f
+                                         for f in table.schema], metadata=table.schema.metadata)
+                self.writer = pq.ParquetWriter(self.tmp, self.schema)
+            self.writer.write_table(table.cast(self.schema))
+        except (pa.ArrowException, ValueError, TypeError):
+            self.abort()
+
+    def abort(self):
+        if self.writer is not None: self.writer.close()
+        self.tmp.unlink(missing_ok=True)
+        self.ok, self.writer = False, None
+
+    def close(self):
+        if not self.ok or self.writer is None: return None
+        self.writer.add_key_value_metadata({STAMP_KEY: _stamp(self.path)})
+        self.writer.close()
+        os.replace(self.tmp, self.side)
+        return self.side
+
+def read_sidecar(path, dtype=None):
+    """Load path's sidecar if it is current, else None.
+
+    dtype=str gives what read_csv(dtype=str).fillna("") would: all strings,
+    blanks as "". Otherwise columns keep their stored types.
+    """
+    side = sidecar_path(path)
+    if not ENABLED or not side.exists() or not os.path.exists(path): return None
+    try:
+        meta = pq.read_metadata(side).metadata or {}  # file key-value metadata (SidecarWriter adds the stamp last)
+        if meta.get(STAMP_KEY) != _stamp(path): return None  # stale: the source changed since
+        df = pq.read_table(side).to_pandas()
+    except Exception:  # unreadable sidecar, fall back to the text file
+        return None
+    if dtype is str:
+        df = as_text(df)
+    return df
+
+def as_text(df):
+    # what read_csv(dtype=str).fillna("") gives back for df: all strings, blanks as ""
+    return df.astype("string").fillna("").astype(object)
+
+def sniff_encoding(path, size=SNIFF_BYTES):
+    """Guess a text file's encoding from its BOM and a `size`-byte sample.
+
+    Pure-ASCII blocks say nothing and are skipped (bytes.isascii is far cheaper
+    than parsing), so the sample is the first block with non-ASCII bytes - an
+    export whose Chinese records come last is still sniffed right.
+    """
+    with open(path, "rb") as f:
+        head = f.read(4)
+        if head.startswith(codecs.BOM_UTF8): return "utf-8-sig"
+        if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)): return "utf-16"
+        f.seek(0)
+        while True:
+            block = f.read(size)
+            if not block: return ENCODINGS[0]  # plain ASCII
+            if not block.isascii(): break
+    for enc in ENCODINGS[:-1]:
+        try:
+            # incremental decode: a character cut off at the block's end is fine
+            codecs.getincrementaldecoder(enc)().decode(block, final=len(block) < size)
+            return enc
+        except UnicodeDecodeError:
+            continue
+    return ENCODINGS[-1]
+
+def _fallbacks(enc):
+    base = "utf-8" if enc == "utf-8-sig" else enc
+    return [enc] + list(ENCODINGS[ENCODINGS.index(base) + 1:]) if base in ENCODINGS else [enc]
+
+def _iter_csv(path, encs, chunksize, kw):
+    done = 0
+    for k, enc in enumerate(encs):
+        try:
+            seen = 0
+            for chunk in pd.read_csv(path, encoding=enc, chunksize=chunksize, **kw):
+                # after a fallback restart, drop the rows already handed out
+                skip = min(max(done - seen, 0), len(chunk))
+                seen += len(chunk)
+                if skip < len(chunk):
+                    done += len(chunk) - skip
+                    yield chunk.iloc[skip:]
+            return
+        except UnicodeDecodeError:
+            if k == len(encs) - 1: raise
+
+def read_csv_any(path, chunksize=None, **kw):
+    """Read a CSV of unknown encoding, parsing it once.
+
+    The encoding is sniffed from a bounded sample; only if a byte past the
+    sample disproves it is the file re-read with the next candidate
+    (utf-8 -> gb18030 -> latin-1). With chunksize, returns an iterator of
+    DataFrames like pd.read_csv(chunksize=...); on such a fallback the rows
+    already handed out are skipped, not re-decoded.
+    """
+    encs = _fallbacks(sniff_encoding(path))
+    if chunksize: return _iter_csv(path, encs, chunksize, kw)
+    for k, enc in enumerate(encs):
+        try:
+            return pd.read_csv(path, encoding=enc, **kw)
+        except UnicodeDecodeError:
+            if k == len(encs) - 1: raise
+
+def write_screening_xlsx(path, screening, reasons=EXCLUSION_REASONS):
+    """Write a screening workbook in one streaming pass.
+
+    openpyxl write-only mode: rows go straight to the file instead of into a
+    cell tree, and the dropdowns on incl_titleabs_yesno / exclusion_reason are
+    written in the same pass, so the file is never re-opened. Sheets:
+    Screening, Dictionary (allowed exclusion reasons), YesNo.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Border, Font, Side
+    from openpyxl.utils import get_column_letter
+    from openpyxl.worksheet.datavalidation import DataValidation
+
+    wb = Workbook(write_only=True)
+    thin = Side(style="thin")
+    def sheet(name, frame):
+        ws = wb.create_sheet(name)
+        head = []
+        for c in frame.columns:  # same header look as DataFrame.to_excel
+            cell = WriteOnlyCell(ws, value=str(c))
+            cell.font, cell.border = Font(bold=True), Border(thin, thin, thin, thin)
+            cell.alignment = Alignment(horizontal="center", vertical="top")
+            head.append(cell)
+        ws.append(head)
+        frame = frame.astype(object).where(frame.notna(), None)
+        for row in frame.itertuples(index=False, name=None):
+            ws.append([None if v == "" else v for v in row])
+        return ws
+
+    ws = sheet("Screening", screening)
+    sheet("Dictionary", pd.DataFrame({"Allowed_Values": reasons}))
+    sheet("YesNo", pd.DataFrame({"YesNo": ["yes", "no"]}))
+    last = len(screening) + 1
+    for col, formula in (("incl_titleabs_yesno", "=YesNo!$A$2:$A$3"),
+                         ("exclusion_reason", f"=Dictionary!$A$2:$A${len(reasons) + 1}")):
+        if col not in screening.columns: continue
+        letter = get_column_letter(list(screening.columns).index(col) + 1)
+        dv = DataValidation(type="list", formula1=formula, allow_blank=True)
+        dv.add(f"{letter}2:{letter}{last}")
+        ws.data_validations.append(dv)
+    wb.save(path)
+
+def _write_xlsx_reload(path, screening, reasons=EXCLUSION_REASONS):
+    # the path write_screening_xlsx replaces (06 before), kept for --bench-xlsx
+    from openpyxl import load_workbook
+    from openpyxl.worksheet.datavalidation import DataValidation
+    with pd.ExcelWriter(path, engine="openpyxl") as w:
+        screening.to_excel(w, index=False, sheet_name="Screening")
+        pd.DataFrame({"Allowed_Values": reasons}).to_excel(w, index=False, sheet_name="Dictionary")
+        pd.DataFrame({"YesNo": ["yes", "no"]}).to_excel(w, index=False, sheet_name="YesNo")
+    wb = load_workbook(path); ws = wb["Screening"]; max_row = ws.max_row
+    dv = DataValidation(type="list", formula1="=YesNo!$A$2:$A$3", allow_blank=True); ws.add_data_validation(dv); dv.add(f"B2:B{max_row}")
+    dv = DataValidation(type="list", formula1=f"=Dictionary!$A$2:$A${len(reasons) + 1}", allow_blank=True); ws.add_data_validation(dv); dv.add(f"C2:C{max_row}")
+    wb.save(path)
+
+def _read_csv_retry(path, **kw):
+    # the loop read_csv_any replaces, kept for --bench
+    for enc in ("utf-8", "utf-8-sig", "gb18030", "latin-1"):
+        try:
+            return pd.read_csv(path, encoding=enc, **kw)
+        except Exception:
+            pass
+
+def bench(csv_dir, ris_dir, copies):
+    """Time read_csv_any vs the retry loop on re-encoded copies of the raw exports."""
+    rows = []
+    for p in sorted(Path(csv_dir).glob("*.csv")):
+        rows.append(read_csv_any(p, dtype=str))
+    if not rows: raise SystemExit(f"no CSV exports in {csv_dir}")
+    df = pd.concat(rows, ignore_index=True)
+    # CJK titles from the CNKI exports, appended last; "-late" has an ASCII-only
+    # head, the worst case for the retry loop (utf-8 fails only near the end)
+    cjk = [m.group(1).strip() for p in sorted(Path(ris_dir).glob("*.ris"))
+           for m in re.finditer(r"^(?:TI|T1)\s+(?:-\s+)?(.*[\u3400-\u9fff].*)$",
+                                Path(p).read_text(encoding=sniff_encoding(p), errors="replace"), re.M)]
+    ascii_rows = df[df.apply(lambda r: "".join(r.fillna("")).isascii(), axis=1)]
+    tail = pd.DataFrame({df.columns[1]: cjk * copies})
+    fixtures = {"utf-8-sig": (df, "utf-8-sig"),
+                "utf-8": (pd.concat([df] * copies + [tail]), "utf-8"),
+                "gb18030": (pd.concat([df] * copies + [tail]), "gb18030"),
+                "gb18030-late": (pd.concat([ascii_rows] * copies + [tail]), "gb18030"),
+                "latin-1": (pd.concat([df] * copies), "latin-1")}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (frame, enc) in fixtures.items():
+            path = Path(tmp) / f"{name}.csv"
+            frame.to_csv(path, index=False, encoding=enc, errors="replace")
+            best = {}
+            for _ in range(3):  # best of 3, alternating
+                for fn in (_read_csv_retry, read_csv_any):
+                    t0 = time.perf_counter(); got = fn(path, dtype=str)
+                    best[fn] = min(best.get(fn, (1e9,))[0], time.perf_counter() - t0), got
+            (old, a), (new, b) = best[_read_csv_retry], best[read_csv_any]
+            print(f"[BENCH] {name:<13} {len(frame):7d} rows {path.stat().st_size/1e6:6.1f} MB  "
+                  f"retry {old:6.3f}s  sniff {new:6.3f}s ({sniff_encoding(path)})  same={a.equals(b)}")
+
+def bench_xlsx(csv_dir, rows):
+    """Time and peak Python heap of both workbook writers on a rows-long sheet."""
+    import tracemalloc
+    src = pd.concat([read_csv_any(p, dtype=str) for p in sorted(Path(csv_dir).glob("*.csv"))], ignore_index=True)
+    src = src.fillna("")
+    reps = -(-rows // len(src))
+    sheet = pd.concat([src] * reps, ignore_index=True).iloc[:rows]
+    sheet.insert(0, "study_id", [f"{k:012x}" for k in range(len(sheet))])
+    sheet.insert(1, "incl_titleabs_yesno", "")
+    sheet.insert(2, "exclusion_reason", "")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, fn in (("reload", _write_xlsx_reload), ("stream", write_screening_xlsx)):
+            path = Path(tmp) / f"{name}.xlsx"
+            t0 = time.perf_counter(); fn(path, sheet); secs = time.perf_counter() - t0
+            tracemalloc.start(); fn(path, sheet); peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+            print(f"[BENCH] xlsx {name:<7} {len(sheet):7d} rows  {secs:7.2f}s  peak heap {peak/1e6:8.1f} MB  "
+                  f"{path.stat().st_size/1e6:6.1f} MB file")
+
+if __name__ == "__main__":
+    base = Path(__file__).resolve().parents[1] / "data_raw"
+    ap = argparse.ArgumentParser(description="bib_io checks")
+    ap.add_argument("--bench", action="store_true", help="benchmark read_csv_any on data_raw/csv fixtures")
+    ap.add_argument("--copies", type=int, default=200, help="replicate the fixtures N times")
+    ap.add_argument("--bench-xlsx", type=int, metavar="ROWS", help="benchmark the screening workbook writers")
+    args = ap.parse_args()
+    if not args.bench and not args.bench_xlsx: ap.error("nothing to do (use --bench or --bench-xlsx N)")
+    if args.bench: bench(base / "csv", base / "ris", args.copies)
+    if args.bench_xlsx: bench_xlsx(base / "csv", args.bench_xlsx)
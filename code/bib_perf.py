@@ -0,0 +1,123 @@
+# bib_perf.py
+# Shared timing/memory instrumentation for the pipeline scripts.
+# Each script calls start() once, wraps its sub-steps in `with step(name):`
+# and calls finish(). Wall time, row counts and peak RSS per step end up in
+# data_clean/run_report.json under the script's stage name (the other stages'
+# entries are kept, so the file describes the last run of every stage).
+# --profile cprofile|tracemalloc adds the top functions / allocation sites.
+
+import os, sys, json, time, atexit
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+REPORT = Path(__file__).resolve().parents[1] / "data_clean" / "run_report.json"
+TOP_N = 25
+_run = None
+
+def add_args(ap):
+    g = ap.add_argument_group("instrumentation")
+    g.add_argument("--report", type=Path, default=Path(os.getenv("BIB_REPORT", REPORT)),
+                   help="JSON run report to update (default data_clean/run_report.json, or $BIB_REPORT)")
+    g.add_argument("--profile", choices=["cprofile", "tracemalloc"], default=os.getenv("BIB_PROFILE") or None,
+                   help="also profile functions (cProfile) or Python allocations (tracemalloc)")
+
+def peak_rss_mb():
+    if resource is None: return None
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss: bytes on macOS, KiB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale  # --jobs workers
+    return round(max(own, kids) / 1e6, 1)
+
+class Run:
+    def __init__(self, stage, report, profile=None):
+        self.stage, self.report, self.profile = stage, Path(report), profile
+        self.t0, self.steps, self.extra, self.depth = time.perf_counter(), [], {}, 0
+        self.started = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self.prof = None
+        if profile == "cprofile":
+            import cProfile
+            self.prof = cProfile.Profile(); self.prof.enable()
+        elif profile == "tracemalloc":
+            import tracemalloc
+            tracemalloc.start()
+
+    def _profile_summary(self):
+        if self.profile == "cprofile":
+            import pstats
+            self.prof.disable()
+            dump = self.report.with_name(f"{self.stage}.prof")  # for snakeviz / pstats
+            self.prof.dump_stats(dump)
+            rows = sorted(pstats.Stats(self.prof).stats.items(), key=lambda kv: -kv[1][3])[:TOP_N]  # by cumtime
+            return {"prof_file": str(dump),
+                    "top": [{"func": f"{Path(f).name}:{line}({name})", "ncalls": nc, "tottime": round(tt, 4),
+                             "cumtime": round(ct, 4)} for (f, line, name), (cc, nc, tt, ct, _) in rows]}
+        if self.profile == "tracemalloc":
+            import tracemalloc
+            snap = tracemalloc.take_snapshot().statistics("lineno")[:TOP_N]
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return {"py_peak_mb": round(peak / 1e6, 1),
+                    "top": [{"site": str(s.traceback[0]), "mb": round(s.size / 1e6, 2), "count": s.count} for s in snap]}
+
+    def finish(self, **extra):
+        global _run
+        self.extra.update(extra)
+        entry = {"started": self.started, "status": "ok", "argv": sys.argv[1:], "seconds": round(time.perf_counter() - self.t0, 3),
+                 "peak_rss_mb": peak_rss_mb(), **self.extra, "steps": self.steps}
+        if self.profile: entry["profile"] = {"mode": self.profile, **self._profile_summary()}
+        self.report.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            doc = json.loads(self.report.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            doc = {}
+        doc.setdefault("stages", {})[self.stage] = entry
+        tmp = self.report.with_name(self.report.name + ".tmp")
+        tmp.write_text(json.dumps(doc, indent=1, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.report)
+        _run = None
+        return entry
+
+def start(stage, args):
+    """Begin instrumenting this script; the report is written by finish() (or at exit)."""
+    global _run
+    _run = Run(stage, args.report, args.profile)
+    atexit.register(lambda: _run and _run.finish(status="incomplete"))
+    return _run
+
+def active():
+    return _run is not None
+
+def finish(**extra):
+    return _run.finish(**extra) if _run else None
+
+def note(**extra):
+    # stage-level facts for the report (rows in/out, cache hits, ...)
+    if _run: _run.extra.update(extra)
+
+@contextmanager
+def step(name, rows=None):
+    """Time a sub-step; set info["rows"] inside the block if the count is known only then."""
+    info = {"rows": rows}
+    if _run is None:
+        yield info; return
+    t0 = time.perf_counter()
+    if _run.profile == "tracemalloc":
+        import tracemalloc
+        tracemalloc.reset_peak()
+    rec = {"name": name, "depth": _run.depth}
+    _run.steps.append(rec)  # in start order, nested steps after their parent
+    _run.depth += 1
+    try:
+        yield info
+    finally:
+        _run.depth -= 1
+        rec.update(seconds=round(time.perf_counter() - t0, 4), rows=info["rows"], peak_rss_mb=peak_rss_mb())
+        if _run.profile == "tracemalloc":  # since this step, or its last sub-step, began
+            import tracemalloc
+            rec["py_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
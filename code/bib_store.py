@@ -0,0 +1,147 @@
+# bib_store.py
+# Optional SQLite record store shared by the pipeline stages.
+# The flat files stay the interface for humans; with --db (or $BIB_DB) the
+# stages also keep one keyed copy of the data:
+#   records    one row per combined_raw.csv row (merge), plus dedupe's rec_id,
+#              fingerprint, norm_title and kept/dup_of (dedupe)
+#   screening  one row per study_id: the sheet columns (06), human decisions
+#              and autoscreen suggestions (07), updated in place by key
+# DOI, norm_title, year and study_id are indexed, so "is this DOI already
+# screened?" is an index lookup instead of a scan of the sheet.
+
+import os, sqlite3
+from pathlib import Path
+import pandas as pd
+
+DEFAULT_DB = Path(__file__).resolve().parents[1] / "data_clean" / "bib.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    row INTEGER PRIMARY KEY,            -- 1-based position in combined_raw.csv
+    source_file TEXT, src_type TEXT, title TEXT, authors TEXT, year INTEGER,
+    journal TEXT, doi TEXT, url TEXT, abstract TEXT, keywords TEXT, issn TEXT,
+    volume TEXT, issue TEXT, pages TEXT,
+    rec_id INTEGER, fp TEXT, norm_title TEXT, kept INTEGER, dup_of INTEGER, dup_reason TEXT
+);
+CREATE INDEX IF NOT EXISTS records_doi ON records(doi);
+CREATE INDEX IF NOT EXISTS records_norm_title ON records(norm_title);
+CREATE INDEX IF NOT EXISTS records_year ON records(year);
+CREATE INDEX IF NOT EXISTS records_rec_id ON records(rec_id);
+CREATE TABLE IF NOT EXISTS screening (
+    study_id TEXT PRIMARY KEY,
+    title TEXT, authors TEXT, year TEXT, journal TEXT, abstract TEXT, keywords TEXT, doi TEXT, url TEXT,
+    incl_titleabs_yesno TEXT DEFAULT '', exclusion_reason TEXT DEFAULT '',
+    auto_yesno TEXT DEFAULT '', auto_reason TEXT DEFAULT '', rules_version TEXT DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS screening_doi ON screening(doi);
+"""
+DECISION_COLS = ["incl_titleabs_yesno", "exclusion_reason"]
+
+def db_path(arg=None):
+    """--db value, else $BIB_DB, else None (store disabled). --db with no value = DEFAULT_DB."""
+    if arg == "": return DEFAULT_DB
+    return arg or os.getenv("BIB_DB") or None
+
+def connect(path):
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.executescript(SCHEMA)
+    return con
+
+def _q(c):
+    return '"' + str(c).replace('"', '""') + '"'
+
+def _columns(con, table):
+    return [r[1] for r in con.execute(f"PRAGMA table_info({table})")]
+
+def _ensure_columns(con, table, cols):
+    have = set(_columns(con, table))
+    for c in cols:
+        if c not in have:  # e.g. a field merge added later
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {_q(c)} TEXT")
+
+def _py(frame):
+    # NaN/NA -> NULL, numpy scalars -> python, for executemany
+    frame = frame.astype(object).where(frame.notna(), None)
+    return [tuple(v.item() if hasattr(v, "item") else v for v in r)
+            for r in frame.itertuples(index=False, name=None)]
+
+def load_records(con, df):
+    """Replace the records table with combined_raw (merge rebuilds it every run)."""
+    cols = list(df.columns)
+    _ensure_columns(con, "records", cols)
+    df = df.assign(year=pd.to_numeric(df["year"], errors="coerce").astype("Int64")) if "year" in df else df
+    with con:
+        con.execute("DELETE FROM records")
+        ph = ", ".join("?" * (len(cols) + 1))
+        con.executemany(f"INSERT INTO records (row, {', '.join(map(_q, cols))}) VALUES ({ph})",
+                        [(k + 1,) + r for k, r in enumerate(_py(df[cols]))])
+    return len(df)
+
+def update_dedupe(con, rows, rec_id, fp, norm_title, kept, dup_of, dup_reason):
+    """Write dedupe's keys and verdict onto records by row (1-based combined_raw position)."""
+    data = pd.DataFrame({"rec_id": rec_id, "fp": fp, "norm_title": norm_title, "kept": kept,
+                         "dup_of": dup_of, "dup_reason": dup_reason, "row": rows})
+    with con:
+        con.execute("UPDATE records SET rec_id=NULL, fp=NULL, norm_title=NULL, kept=NULL, dup_of=NULL, dup_reason=NULL")
+        con.executemany("UPDATE records SET rec_id=?, fp=?, norm_title=?, kept=?, dup_of=?, dup_reason=? WHERE row=?",
+                        _py(data.astype({"dup_of": "Int64"})))
+
+def upsert_sheet(con, work, refresh=True):
+    """Add screening rows from a sheet, keeping decisions already in the store.
+
+    refresh=False only inserts study_ids the store doesn't have yet. Returns
+    the sheet with blank decision columns filled from the store, by study_id
+    first, then by DOI (same paper under another study_id).
+    """
+    cols = [c for c in work.columns if c not in DECISION_COLS]
+    _ensure_columns(con, "screening", cols)
+    sets = ", ".join(f"{_q(c)} = excluded.{_q(c)}" for c in cols if c != "study_id")
+    action = f"DO UPDATE SET {sets}" if refresh and sets else "DO NOTHING"
+    with con:
+        con.executemany(f"INSERT INTO screening ({', '.join(map(_q, cols))}) VALUES ({', '.join('?' * len(cols))}) "
+                        f"ON CONFLICT(study_id) {action}", _py(work[cols].drop_duplicates("study_id")))
+    out = work.copy()
+    doi = out["doi"] if "doi" in out.columns else pd.Series("", index=out.index)
+    known = screened(con, study_ids=out["study_id"], dois=doi[doi.ne("")])
+    by_id = known.drop_duplicates("study_id").set_index("study_id")
+    by_doi = known[known["doi"].ne("")].drop_duplicates("doi").set_index("doi")
+    for c in DECISION_COLS:
+        carried = out["study_id"].map(by_id[c]).fillna(doi.map(by_doi[c])).fillna("")
+        out[c] = out[c].where(out[c].ne(""), carried)
+    return out
+
+def screened(con, study_ids=None, dois=None):
+    """Rows with a human decision: all of them, or those with one of the given
+    study_ids or DOIs.
+
+    The keys go into temp tables that are joined on the primary key and the DOI
+    index, so the lookup reads only matching rows, not the whole sheet.
+    """
+    sql = ("SELECT study_id, COALESCE(doi, '') AS doi, incl_titleabs_yesno, exclusion_reason FROM screening "
+           "WHERE incl_titleabs_yesno != ''")
+    if study_ids is None and dois is None:
+        return pd.read_sql_query(sql, con)
+    parts = []
+    for name, col, keys in (("want_id", "study_id", study_ids), ("want_doi", "doi", dois)):
+        if keys is None: continue
+        con.execute(f"CREATE TEMP TABLE IF NOT EXISTS {name} (k TEXT PRIMARY KEY)")
+        con.execute(f"DELETE FROM temp.{name}")
+        con.executemany(f"INSERT OR IGNORE INTO temp.{name} VALUES (?)", [(str(k),) for k in keys])
+        parts.append(f"{sql} AND {col} IN (SELECT k FROM temp.{name})")
+    return pd.read_sql_query(" UNION ".join(parts), con)
+
+def update_decisions(con, study_ids, yesno, reason, auto=False, version=None):
+    """Update just the decision columns of screening rows by study_id.
+
+    auto=True writes autoscreen's suggestion (auto_yesno / auto_reason) with
+    the rules version; human decisions are never touched by it.
+    """
+    if auto:
+        sql = "UPDATE screening SET auto_yesno = ?, auto_reason = ?, rules_version = ? WHERE study_id = ?"
+        rows = [(y, r, version, s) for s, y, r in zip(study_ids, yesno, reason)]
+    else:
+        sql = "UPDATE screening SET incl_titleabs_yesno = ?, exclusion_reason = ? WHERE study_id = ?"
+        rows = list(zip(yesno, reason, study_ids))
+    with con:
+        return con.executemany(sql, rows).rowcount
@@ -1,22 +1,44 @@
 # dedupe_bib.py
-# Deduplicate combined_raw.csv by DOI and (title similarity + year proximity)
+# Deduplicate combined_raw.csv by DOI, ISSN+year+issue+pages and (title similarity + year proximity);
+# matches are clustered transitively (union-find) and each cluster keeps one primary
 # Outputs:
 #   data_clean/master_bibliography.csv
-#   data_clean/duplicates_report.csv
+#   data_clean/duplicates_report.csv  (with the cluster_id of each duplicate)
 #   data_clean/excluded_duplicates.csv
+#   data_clean/dedupe_index.csv  (state for --incremental)
+# (each with a .parquet sidecar when pyarrow is installed, see bib_io.py)
 
-import os, re, sys
+import os, re, sys, math, time, hashlib, argparse, unicodedata
+from collections import Counter, defaultdict
+from contextlib import closing
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import bib_perf, bib_store
+from bib_io import read_sidecar, write_sidecar
+from bib_perf import step
 
 try:
-    from rapidfuzz import fuzz
+    from rapidfuzz import fuzz, process
 except Exception:
-    # minimal fallback (lower accuracy)
+    process = None
+    # pure-Python fallback: same Indel-normalised ratio as rapidfuzz's fuzz.ratio,
+    # computed with a bit-parallel LCS (Hyyrö 2004) - one big-int step per
+    # character instead of difflib's matching-block search (~5x faster on titles)
     def _simple_ratio(a,b):
         a, b = str(a), str(b)
-        from difflib import SequenceMatcher
-        return int(100 * SequenceMatcher(None, a, b).ratio())
+        if not a and not b: return 100.0
+        if len(a) < len(b): a, b = b, a
+        masks = {}
+        for k, ch in enumerate(a):
+            masks[ch] = masks.get(ch, 0) | (1 << k)
+        full = (1 << len(a)) - 1
+        v = full
+        for ch in b:
+            u = v & masks.get(ch, 0)
+            v = ((v + u) | (v - u)) & full
+        lcs = len(a) - bin(v).count("1")
+        return 200.0 * lcs / (len(a) + len(b))
     class fuzz:
         ratio = staticmethod(_simple_ratio)
 
@@ -26,107 +48,523 @@ IN_CSV = OUT_DIR / "combined_raw.csv"
 OUT_MASTER = OUT_DIR / "master_bibliography.csv"
 OUT_DUPREP = OUT_DIR / "duplicates_report.csv"
 OUT_EXCL = OUT_DIR / "excluded_duplicates.csv"
+OUT_INDEX = OUT_DIR / "dedupe_index.csv"
+INDEX_COLS = ["rec_id", "fp", "doi", "alt_key", "year", "norm_title", "kept", "cluster"]
+KEY_COLS = ["rec_id", "doi", "alt_key", "year", "norm_title"]
 
 TITLE_SIM_THRESHOLD = float(os.getenv("TITLE_SIM_THRESHOLD", "0.92"))  # 0.92 ~ 92%
+GRAM_Q = 3  # shingle size for the candidate index (Latin-script titles)
+CJK_GRAM_Q = 2  # Chinese titles: character bigrams (short titles, one morpheme per character)
+CJK = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+CJK_RE = re.compile(f"[{CJK}]")
+WORKERS = int(os.getenv("DEDUPE_WORKERS", "-1"))  # cdist threads; -1 = all cores
+SCORE_CHUNK = 4_000_000  # cells per cdist matrix (float32, ~16 MB)
 
 def norm_title(t):
+    # lower-case letters/digits plus CJK ideographs (CNKI titles used to normalize
+    # to "" and all match each other); spaces next to a CJK character are dropped,
+    # since Chinese has no word spacing and exports differ in it
     if pd.isna(t): return ""
-    t = str(t).lower().strip()
+    t = unicodedata.normalize("NFKC", str(t)).lower().strip()  # full-width letters/digits -> ASCII
     t = re.sub(r"\s+", " ", t)
-    t = re.sub(r"[^a-z0-9\s]", "", t)
-    return t
-
-def choose_primary(df_grp):
-    # keep the record with DOI; if multiple, the longest abstract; else first
-    with_doi = df_grp[df_grp["doi"].astype(str)!=""]
-    if len(with_doi) >= 1:
-        cand = with_doi.copy()
-    else:
-        cand = df_grp.copy()
-    cand = cand.assign(_ablen=cand["abstract"].astype(str).str.len())
-    return cand.sort_values(["_ablen"], ascending=[False]).iloc[0]
+    t = re.sub(f"[^a-z0-9\\s{CJK}]", "", t)
+    return re.sub(f"(?<=[{CJK}]) | (?=[{CJK}])", "", t)
+
+def _title_q(t):
+    """Shingle size for title t: CJK_GRAM_Q if it is mostly CJK, GRAM_Q if mostly
+    not, None for the mixed ones in between.
+
+    Two titles at >= 92% similarity differ in CJK share by well under the 0.3-0.7
+    gap, so a mostly-CJK and a mostly-Latin title can never match and their
+    shingles need not meet; the mixed titles are compared against everything.
+    """
+    if not t: return GRAM_Q
+    share = len(CJK_RE.findall(t)) / len(t)
+    return CJK_GRAM_Q if share >= 0.7 else GRAM_Q if share <= 0.3 else None
+
+def issn_pages_key(df):
+    """Fallback identity for records without DOI: ISSN + year + issue + page range.
+
+    "" unless all four are present and the pages start with a range (a bare
+    start page repeats across issues too often to be a key; CNKI's "78-81+101"
+    keys as 78-81). The issue is needed because CNKI journals number pages from
+    1 in every issue; volume is left out, CNKI exports have none and the year
+    stands in for it. Issue "04" keys as 4.
+    """
+    blank = pd.Series("", index=df.index)
+    issn = df.get("issn", blank).fillna("").astype(str).str.upper().str.extract(r"(\d{4})-?(\d{3}[\dX])")
+    issue = df.get("issue", blank).fillna("").astype(str).str.extract(r"0*(\d+)", expand=False)
+    pages = df.get("pages", blank).fillna("").astype(str).str.extract(r"^\s*([A-Za-z]?\d+)\s*[-\u2013\u2014~]+\s*([A-Za-z]?\d+)")
+    year = pd.to_numeric(df["year"], errors="coerce")
+    key = issn[0] + issn[1] + "|" + year.map(lambda y: str(int(y)) if pd.notna(y) else "") + "|" + \
+        issue + "|" + pages[0].str.lower() + "-" + pages[1].str.lower()
+    ok = issn[0].notna() & year.notna() & issue.notna() & pages[0].notna()
+    return key.where(ok, "")
+
+def choose_primary(keys, cluster):
+    """Primary row position per cluster (a Series indexed by cluster).
+
+    A record kept by an earlier run (`fixed`) stays primary; otherwise keep the
+    record with DOI; if multiple, the longest abstract; else the first (lowest rec_id).
+    """
+    rank = pd.DataFrame({"fixed": keys["fixed"].to_numpy(), "has_doi": keys["doi"].ne("").to_numpy(),
+                         "ablen": keys["ablen"].to_numpy(), "rec_id": keys["rec_id"].to_numpy(),
+                         "cluster": cluster})
+    rank = rank.sort_values(["fixed", "has_doi", "ablen", "rec_id"], ascending=[False, False, False, True],
+                            kind="stable")
+    first = rank.drop_duplicates("cluster")
+    return pd.Series(first.index.to_numpy(), index=first["cluster"].to_numpy())
+
+def as_year(s):
+    # nullable int, so every way the next stage gets the table (this frame, the
+    # CSV, the sidecar) spells a year "2024" - 06 hashes it into the study_id
+    return pd.to_numeric(s, errors="coerce").astype("Int64")
+
+def _year_key(y):
+    return int(y) if pd.notna(y) else None
+
+def _year_ok(ya, yb):
+    # same rule as the original pass: only reject when both years are known and >1 apart
+    if pd.notna(ya) and pd.notna(yb):
+        return abs(int(ya) - int(yb)) <= 1
+    return True
+
+def _len_bounds(n, cut):
+    # ratio = 200*LCS/(la+lb) <= 200*min(la,lb)/(la+lb), so partners outside
+    # [lo, hi] can never reach `cut`
+    c = cut / 100.0
+    return math.ceil(n * c / (2 - c) - 1e-9), math.floor(n * (2 - c) / c + 1e-9)
+
+def _prefix_len(n, cut, q=GRAM_Q):
+    # q-gram lemma: ratio >= cut caps the indel distance at d, each edit breaks at
+    # most q shingles, so a match shares >= (n-q+1) - q*d of them.  Indexing the
+    # q*d+1 rarest shingles is then enough for every match to meet in the index.
+    # 0 = title too short to filter (compare against everything in the window).
+    c = cut / 100.0
+    d = math.floor((1 - c) * 2 * n / c + 1e-9)
+    if (n - q + 1) - q * d <= 0:
+        return 0
+    return q * d + 1
+
+def _shingles(t, q=GRAM_Q):
+    # occurrence-tagged q-grams, so multiset overlap == set overlap
+    seen, out = {}, []
+    for k in range(len(t) - q + 1):
+        g = t[k:k+q]
+        seen[g] = seen.get(g, 0) + 1
+        out.append((g, seen[g]))
+    return out
+
+def candidate_pairs(titles, years, cut, start=0):
+    """Yield (j, i), j < i, i >= start, for every pair that can still score >= cut.
+
+    Records are blocked on year bucket (y-1, y, y+1, plus unknown years) and a
+    shingle prefix index (character bigrams for Chinese titles, trigrams for
+    the rest, see _title_q); the length bound is applied before yielding.  The
+    filter is lossless for fuzz.ratio - see check_recall().  Empty titles match
+    nothing.
+    """
+    qs = [_title_q(t) for t in titles]
+    shingles = [_shingles(t, q) if q else [] for t, q in zip(titles, qs)]
+    freq = Counter(g for gs in shingles for g in gs)
+    index = defaultdict(lambda: defaultdict(list))  # shingle -> year bucket -> [i]
+    loose = []
+    for i, t in enumerate(titles):
+        if not t: continue
+        y = _year_key(years[i])
+        p = _prefix_len(len(t), cut, qs[i]) if qs[i] else 0
+        if p:
+            prefix = sorted(shingles[i], key=lambda g: (freq[g], g))[:p]
+            cands = set(loose)
+            for g in prefix:
+                by_year = index.get(g)
+                if not by_year: continue
+                keys = list(by_year) if y is None else (y-1, y, y+1, None)
+                for k in keys:
+                    cands.update(by_year.get(k, ()))
+            for g in prefix:
+                index[g][y].append(i)
+        else:
+            cands = range(i)
+            loose.append(i)
+        if i < start: continue
+        lo, hi = _len_bounds(len(t), cut)
+        for j in sorted(cands):
+            if titles[j] and lo <= len(titles[j]) <= hi and _year_ok(years[j], years[i]):
+                yield j, i
+
+def batch_match_pairs(titles, years, cut, workers=None, start=0):
+    """Score year blocks as matrices with rapidfuzz.process.cdist.
+
+    Each year bucket is scored against its y-1..y+1 (+ unknown year) window,
+    mostly-CJK and mostly-Latin titles only against their own script (plus the
+    mixed ones, see _title_q); empty titles are left out.
+    Both sides are sorted by length and chunked so a query chunk only meets the
+    length band it can match; the matrix is cut at `cut` and only i < j kept.
+    Only rows >= start are used as queries (incremental runs).
+    """
+    workers = WORKERS if workers is None else workers
+    n = len(titles)
+    lens = np.fromiter((len(t) for t in titles), dtype=np.int64, count=n)
+    buckets = defaultdict(list)  # (year, script) -> [i]
+    for i, (t, y) in enumerate(zip(titles, years)):
+        if t: buckets[(_year_key(y), _title_q(t))].append(i)
+    out = []
+    for (y, s), q_ids in buckets.items():
+        ys = {k for k, _ in buckets} if y is None else (y-1, y, y+1, None)
+        ss = {k for _, k in buckets} if s is None else (s, None)
+        c_ids = np.array(sorted(i for a in ys for b in ss for i in buckets.get((a, b), ())), dtype=np.int64)
+        c_ids = c_ids[np.argsort(lens[c_ids], kind="stable")]
+        c_lens = lens[c_ids]
+        q_ids = np.array([i for i in q_ids if i >= start], dtype=np.int64)
+        if not len(q_ids): continue
+        q_ids = q_ids[np.argsort(lens[q_ids], kind="stable")]
+        chunk = max(1, SCORE_CHUNK // len(c_ids))
+        for k in range(0, len(q_ids), chunk):
+            q = q_ids[k:k+chunk]
+            a = np.searchsorted(c_lens, _len_bounds(lens[q[0]], cut)[0], "left")
+            b = np.searchsorted(c_lens, _len_bounds(lens[q[-1]], cut)[1], "right")
+            c = c_ids[a:b]
+            if not len(c): continue
+            m = process.cdist([titles[i] for i in q], [titles[j] for j in c],
+                              scorer=fuzz.ratio, score_cutoff=cut, workers=workers)
+            qi, cj = np.nonzero(m >= cut)
+            for x, z in zip(q[qi], c[cj]):
+                if z < x:
+                    # matches are rare: re-score in double precision for the report
+                    score = fuzz.ratio(titles[z], titles[x])
+                    if score >= cut:
+                        out.append((int(z), int(x), score))
+    return sorted(out)
+
+def title_match_pairs(titles, years, cut, start=0):
+    # (i, j, score) with i < j, j >= start for every pair at or above the cut-off
+    if process is not None:
+        return batch_match_pairs(titles, years, cut, start=start)
+    out = []
+    for j, i in candidate_pairs(titles, years, cut, start=start):
+        score = fuzz.ratio(titles[j], titles[i])
+        if score >= cut:
+            out.append((j, i, score))
+    return sorted(out)
+
+def brute_force_pairs(titles, years, cut):
+    # reference O(n^2) scan, kept for check_recall()
+    out = []
+    for i in range(len(titles)):
+        if not titles[i]: continue
+        for j in range(i+1, len(titles)):
+            if not titles[j] or not _year_ok(years[i], years[j]): continue
+            score = fuzz.ratio(titles[i], titles[j])
+            if score >= cut:
+                out.append((i, j, score))
+    return out
+
+class DisjointSet:
+    """Union-find over row positions (path halving, union by size).
+
+    A set never takes two different DOIs, or two records kept by an earlier run
+    (`fixed`): union() refuses such a merge and returns False, so a title that is
+    close to two distinct works joins only the first one it is unioned with.
+    """
+    def __init__(self, doi, fixed):
+        n = len(doi)
+        self.parent, self.size = list(range(n)), [1] * n
+        self.doi, self.fixed = list(doi), list(fixed)
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        a, b = self.find(i), self.find(j)
+        if a == b: return True
+        if self.doi[a] and self.doi[b] and self.doi[a] != self.doi[b]: return False
+        if self.fixed[a] and self.fixed[b]: return False
+        if self.size[a] < self.size[b]: a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        self.doi[a] = self.doi[a] or self.doi[b]
+        self.fixed[a] = self.fixed[a] or self.fixed[b]
+        return True
 
-def main():
-    if not IN_CSV.exists():
+    def roots(self):
+        return np.array([self.find(i) for i in range(len(self.parent))], dtype=np.int64)
+
+def key_edges(keys):
+    # (first row, row) for every further row with the same non-blank key
+    s = pd.Series(np.asarray(keys, dtype=object))
+    s = s[s != ""]
+    first = pd.Series(s.index, index=s.index).groupby(s.to_numpy()).transform("first").to_numpy()
+    rows = s.index.to_numpy()
+    return zip(first[first != rows].tolist(), rows[first != rows].tolist())
+
+def title_rows(keys):
+    # positions the title pass compares: one title per DOI is enough, its
+    # records are one set already
+    return np.flatnonzero(~(keys["doi"].ne("") & keys["doi"].duplicated()).to_numpy())
+
+def check_recall(df):
+    """Compare the indexed title pass against the brute-force scan on the pairs a full run scores."""
+    has_doi = df["doi"].ne("")
+    keys = pd.concat([df[has_doi], df[~has_doi]])
+    pos = title_rows(keys)
+    start = int(np.searchsorted(pos, int(has_doi.sum())))
+    titles, years = keys["norm_title"].to_numpy()[pos].tolist(), keys["year"].to_numpy()[pos].tolist()
+    cut = int(TITLE_SIM_THRESHOLD*100)
+    # DOI titles are not compared with each other
+    t0 = time.perf_counter(); ref = [p for p in brute_force_pairs(titles, years, cut) if p[1] >= start]
+    t1 = time.perf_counter(); got = title_match_pairs(titles, years, cut, start=start)
+    t2 = time.perf_counter()
+    missed = set((i, j) for i, j, _ in ref) - set((i, j) for i, j, _ in got)
+    engine = "cdist" if process is not None else "indexed"
+    print(f"[RECALL] {len(pos)} titles ({start} with DOI): pairwise loop {len(ref)} pairs in {t1-t0:.2f}s, "
+          f"{engine} {len(got)} pairs in {t2-t1:.2f}s "
+          f"(x{(t1-t0)/max(t2-t1, 1e-9):.1f}), missed {len(missed)}.")
+    return not missed
+
+def record_fingerprints(df):
+    # identity of a merged row across runs, so --incremental can keep its rec_id;
+    # identical rows are told apart by occurrence (#0, #1, ...)
+    year = df["year"].map(lambda y: str(int(y)) if pd.notna(y) else "")
+    cols = [df[c].fillna("").astype(str) for c in ("source_file", "title", "authors", "doi")] + [year]
+    base = pd.Series([hashlib.md5("|".join(v).encode("utf-8", "ignore")).hexdigest() for v in zip(*cols)],
+                     index=df.index)
+    return base + "#" + base.groupby(base).cumcount().astype(str)
+
+def key_table(df):
+    """The part of df that matching looks at: keys plus abstract length (for primaries).
+
+    The passes below work on this and return row labels of df, so abstracts and
+    the other wide columns are only touched again when the outputs are taken.
+    """
+    return df[KEY_COLS].assign(ablen=df["abstract"].astype(str).str.len())
+
+def cluster_records(keys, start):
+    """Union DOI, ISSN+pages and title matches of `keys` (positional) into clusters.
+
+    Rows before `start` are title candidates only (DOI rows in a full run, their
+    titles are compared with the no-DOI ones; indexed records in an incremental
+    run); rows from `start` on are also matched with each other. Rows that share
+    a `cluster` id from an earlier run start out as one set.
+    Returns the root position of every row's cluster.
+    """
+    ds = DisjointSet(keys["doi"].tolist(), keys["fixed"].tolist())
+    earlier = keys["cluster"].astype("Int64").astype(str).where(keys["cluster"].notna(), "")
+    for i, j in key_edges(earlier): ds.union(i, j)
+    with step("doi grouping", rows=int(keys["doi"].ne("").sum())):
+        for i, j in key_edges(keys["doi"]): ds.union(i, j)
+    with step("issn+pages grouping", rows=int(keys["alt_key"].ne("").sum())):
+        for i, j in key_edges(keys["alt_key"]): ds.union(i, j)
+
+    pos = title_rows(keys)
+    with step("fuzzy title pass", rows=len(pos)):
+        pairs = title_match_pairs(keys["norm_title"].to_numpy()[pos].tolist(), keys["year"].to_numpy()[pos].tolist(),
+                                  int(TITLE_SIM_THRESHOLD*100), start=int(np.searchsorted(pos, start)))
+        # best matches first, so where a merge is refused the closer work has it
+        for i, j, _ in sorted(pairs, key=lambda p: -p[2]):
+            ds.union(int(pos[i]), int(pos[j]))
+    return ds.roots()
+
+def dedupe_clusters(keys, start):
+    """Cluster `keys` and pick primaries.
+
+    Returns (primary positions, duplicates report, duplicate positions, cluster
+    id per row). A cluster's id is its smallest rec_id, or the id an earlier run
+    gave it; a duplicate's reason is the key it shares with its primary, and
+    `score` is their title similarity when that is the title alone.
+    """
+    roots = cluster_records(keys, start)
+    with step("primaries", rows=len(keys)):
+        primary = choose_primary(keys, roots)
+        prim = primary.reindex(roots).to_numpy()
+        cid = keys["cluster"].fillna(keys["rec_id"]).groupby(roots).transform("min").astype(int).to_numpy()
+        d = np.flatnonzero(prim != np.arange(len(keys)))
+        p = prim[d]
+        doi, alt = keys["doi"].to_numpy(), keys["alt_key"].to_numpy()
+        same_doi = (doi[d] != "") & (doi[d] == doi[p])
+        same_alt = ~same_doi & (alt[d] != "") & (alt[d] == alt[p])
+        titles = keys["norm_title"].to_numpy()
+        score = [100 if a or b else int(fuzz.ratio(titles[x], titles[y]))
+                 for a, b, x, y in zip(same_doi, same_alt, d, p)]
+        rec_id = keys["rec_id"].astype(int).to_numpy()
+        dups = pd.DataFrame({"dup_id": rec_id[d], "kept_id": rec_id[p],
+                             "reason": np.select([same_doi, same_alt], ["duplicate_doi", "duplicate_issn_pages"],
+                                                 "duplicate_title"),
+                             "score": score, "doi": np.where(same_doi, doi[d], ""), "cluster_id": cid[d]},
+                            columns=["dup_id", "kept_id", "reason", "score", "doi", "cluster_id"])
+        dups = dups.sort_values(["cluster_id", "dup_id"], kind="stable").reset_index(drop=True)
+    kept = primary.to_numpy()
+    return np.sort(kept[~keys["fixed"].to_numpy()[kept]]), dups, d, cid
+
+def dedupe_full(df):
+    # df: key_table(); returns (kept labels, duplicates report, excluded labels, cluster id by label)
+    # DOI rows go first: the title pass compares the rest with them but not them with each other
+    has_doi = df["doi"].ne("")
+    keys = pd.concat([df[has_doi], df[~has_doi]]).assign(fixed=False, cluster=np.nan)
+    labels = keys.index.to_numpy()
+    kept, dups, excl, cid = dedupe_clusters(keys.reset_index(drop=True), int(has_doi.sum()))
+    return labels[kept], dups, labels[excl], pd.Series(cid, index=labels)
+
+def dedupe_incremental(new, index):
+    """Match only the new rows: against the indexed records, then each other.
+
+    Every indexed record takes part, so a DOI or ISSN+pages key held only by an
+    excluded duplicate still leads to its cluster. Records already kept stay
+    primary (and keep their cluster id), so earlier decisions never change; two
+    of them are never merged.
+    """
+    old = index[KEY_COLS + ["cluster"]].assign(ablen=0, fixed=index["kept"].eq(1))
+    has_doi = new["doi"].ne("")
+    keys = pd.concat([f for f in (old, new[has_doi].assign(fixed=False), new[~has_doi].assign(fixed=False)) if len(f)])
+    labels = keys.index.to_numpy()
+    kept, dups, excl, cid = dedupe_clusters(keys.reset_index(drop=True), len(old))
+    # indexed duplicates are already in the reports
+    dups = dups[~dups["dup_id"].isin(old["rec_id"])].reset_index(drop=True)
+    excl = excl[excl >= len(old)]
+    return labels[kept], dups, labels[excl], pd.Series(cid[len(old):], index=labels[len(old):])
+
+def load_index():
+    if not OUT_INDEX.exists() or not OUT_MASTER.exists(): return None
+    index = read_sidecar(OUT_INDEX)
+    if index is None:
+        index = pd.read_csv(OUT_INDEX, dtype={"fp": str, "doi": str, "alt_key": str, "norm_title": str})
+    if not {"alt_key", "cluster"} <= set(index.columns):
+        # written before CJK-aware titles, the ISSN+pages key and clustering: its
+        # norm_titles are stale and it has no cluster ids
+        print("[INFO] dedupe index is from an older version.")
+        return None
+    index["doi"] = index["doi"].fillna("")
+    index["alt_key"] = index["alt_key"].fillna("")
+    if not index["alt_key"].str.count(r"\|").isin([0, 3]).all():
+        # ISSN+pages keys written before the issue joined them never match new ones
+        print("[INFO] dedupe index is from an older version.")
+        return None
+    index["norm_title"] = index["norm_title"].fillna("")
+    index["year"] = as_year(index["year"])
+    return index
+
+def _read_prev(path):
+    prev = read_sidecar(path)
+    if prev is None:
+        try:
+            prev = pd.read_csv(path)
+        except Exception:  # missing or empty file
+            return pd.DataFrame()
+    if "year" in prev.columns: prev["year"] = as_year(prev["year"])  # older runs wrote "2024.0"
+    return prev
+
+def main(argv=None, df=None):
+    # df: combined_raw already in memory (run_pipeline.py); returns the kept records
+    ap = argparse.ArgumentParser(description="Deduplicate combined_raw.csv")
+    ap.add_argument("--check-recall", action="store_true",
+                    help="compare the indexed title pass against the brute-force scan and exit")
+    ap.add_argument("--workers", type=int, default=None,
+                    help="threads for rapidfuzz cdist (default $DEDUPE_WORKERS or -1 = all cores)")
+    ap.add_argument("--incremental", action="store_true",
+                    help="only match rows not yet in dedupe_index.csv; keeps existing rec_ids")
+    ap.add_argument("--db", nargs="?", const="", default=None,
+                    help="also update the SQLite record store (default path data_clean/bib.sqlite, or $BIB_DB)")
+    bib_perf.add_args(ap)
+    args = ap.parse_args(argv)
+    if args.workers is not None:
+        global WORKERS
+        WORKERS = args.workers
+    if df is None and not IN_CSV.exists():
         print(f"[WARN] {IN_CSV} not found. Run merge_bib.py first.", file=sys.stderr)
         return
-    df = pd.read_csv(IN_CSV)
+    bib_perf.start("dedupe", args)
+    with step("load") as st:
+        if df is None: df = read_sidecar(IN_CSV)
+        if df is None: df = pd.read_csv(IN_CSV)
+        st["rows"] = len(df)
     if df.empty:
         print("[WARN] combined_raw.csv is empty.")
-        df.to_csv(OUT_MASTER, index=False); return
-
-    df["rec_id"] = range(1, len(df)+1)
-    df["doi"] = df["doi"].fillna("").astype(str)
-    df["year"] = pd.to_numeric(df["year"], errors="coerce")
-    df["norm_title"] = df["title"].apply(norm_title)
-
-    kept = []
-    dup_rows = []
-    excluded = []
-
-    # 1) Exact DOI duplicates
-    by_doi = df[df["doi"]!=""].groupby("doi", dropna=False)
-    used_ids = set()
-    for doi, grp in by_doi:
-        if len(grp) == 1:
-            kept.append(grp.iloc[0])
-            used_ids.add(int(grp.iloc[0]["rec_id"]))
-        else:
-            winner = choose_primary(grp)
-            kept.append(winner)
-            used_ids.add(int(winner["rec_id"]))
-            for _, r in grp.iterrows():
-                if int(r["rec_id"]) == int(winner["rec_id"]): continue
-                dup_rows.append({"dup_id": int(r["rec_id"]), "kept_id": int(winner["rec_id"]), "reason": "duplicate_doi", "score": 100, "doi": doi})
-                excluded.append(r)
-
-    # 2) Title-similarity duplicates for items without DOI
-    remain = df[df["rec_id"].apply(lambda x: int(x) not in used_ids)].copy()
-    # split by has_doi
-    remain_no_doi = remain[remain["doi"]==""].copy()
-    remain_yes_doi = remain[remain["doi"]!=""].copy()
-    # add remaining DOI ones directly (unique)
-    for _, r in remain_yes_doi.iterrows():
-        kept.append(r); used_ids.add(int(r["rec_id"]))
-
-    # O(n^2) compare for no DOI (ok for hundreds)
-    visited = set()
-    rows = remain_no_doi.to_dict("records")
-    for i in range(len(rows)):
-        if rows[i]["rec_id"] in visited: continue
-        base = rows[i]
-        winner = base
-        group = [base]
-        visited.add(base["rec_id"])
-        for j in range(i+1, len(rows)):
-            if rows[j]["rec_id"] in visited: continue
-            cand = rows[j]
-            if pd.notna(base["year"]) and pd.notna(cand["year"]):
-                if abs(int(base["year"]) - int(cand["year"])) > 1:
-                    continue
-            score = fuzz.ratio(base["norm_title"], cand["norm_title"])
-            if score >= int(TITLE_SIM_THRESHOLD*100):
-                # mark as duplicate of winner
-                visited.add(cand["rec_id"])
-                dup_rows.append({"dup_id": int(cand["rec_id"]), "kept_id": int(winner["rec_id"]), "reason": "duplicate_title", "score": int(score), "doi": ""})
-                excluded.append(cand)
-        kept.append(winner)
-
-    kept_df = pd.DataFrame(kept).drop(columns=["_ablen"], errors="ignore").sort_values("rec_id")
-    excl_df = pd.DataFrame(excluded).drop(columns=["_ablen"], errors="ignore")
-    dup_df = pd.DataFrame(dup_rows)
+        df.to_csv(OUT_MASTER, index=False)
+        bib_perf.finish(rows_in=0, kept=0, duplicates=0)
+        return df
+
+    with step("normalize keys", rows=len(df)):
+        df["doi"] = df["doi"].fillna("").astype(str)
+        df["year"] = as_year(df["year"])
+        df["norm_title"] = df["title"].apply(norm_title)
+        df["alt_key"] = issn_pages_key(df)
+        fp = record_fingerprints(df)
+    if args.check_recall:
+        df["rec_id"] = range(1, len(df)+1)
+        ok = check_recall(df)
+        bib_perf.finish(rows_in=len(df), recall_ok=ok)
+        sys.exit(0 if ok else 1)
+
+    index = load_index() if args.incremental else None
+    if args.incremental and index is None:
+        print("[INFO] no usable dedupe index, running a full pass.")
+    if index is None:
+        df["rec_id"] = range(1, len(df)+1)
+        kept, dups, excluded, cluster = dedupe_full(key_table(df))
+        prev = None
+    else:
+        ids = dict(zip(index["fp"], index["rec_id"]))
+        known = fp.isin(ids)
+        gone = len(index) - int(known.sum())
+        if gone:
+            print(f"[WARN] {gone} indexed records are no longer in combined_raw.csv; "
+                  "run without --incremental to rebuild.", file=sys.stderr)
+        df["rec_id"] = fp.map(ids)
+        next_id = int(index["rec_id"].max()) + 1
+        df.loc[~known, "rec_id"] = range(next_id, next_id + int((~known).sum()))
+        df["rec_id"] = df["rec_id"].astype(int)
+        print(f"[INFO] incremental: {int((~known).sum())} new of {len(df)} records.")
+        kept, dups, excluded, cluster = dedupe_incremental(key_table(df[~known]), index)
+        prev = [_read_prev(p) for p in (OUT_MASTER, OUT_DUPREP, OUT_EXCL)]
+
+    # the only copies of whole records: one take each for kept and excluded
+    kept = df.index.get_indexer(kept)
+    kept_df = df.take(kept[np.argsort(df["rec_id"].to_numpy()[kept], kind="stable")])
+    excl_df = df.take(df.index.get_indexer(excluded))
+    dup_df = dups
+    if prev is not None:
+        kept_df = pd.concat([prev[0], kept_df]).sort_values("rec_id")
+        excl_df = pd.concat([prev[2], excl_df])
+        dup_df = pd.concat([prev[1], dups])
 
     # add user-screening placeholders
     for col in ["incl_titleabs", "exclusion_reason"]:
         if col not in kept_df.columns: kept_df[col] = ""
 
-    kept_df.to_csv(OUT_MASTER, index=False)
-    dup_df.to_csv(OUT_DUPREP, index=False)
-    excl_df.to_csv(OUT_EXCL, index=False)
+    with step("write outputs", rows=len(kept_df) + len(dup_df) + len(excl_df)):
+        for frame, path in ((kept_df, OUT_MASTER), (dup_df, OUT_DUPREP), (excl_df, OUT_EXCL)):
+            frame.to_csv(path, index=False)
+            write_sidecar(frame, path)
+
+    # persist what --incremental needs: identity, keys and kept flag per row
+    with step("write index", rows=len(df)):
+        idx = df.assign(fp=fp, kept=df["rec_id"].isin(kept_df["rec_id"]).astype(int),
+                        cluster=cluster.reindex(df.index).astype("Int64"))
+        if index is not None:
+            idx = pd.concat([index, idx[~idx["fp"].isin(index["fp"])]])
+        idx = idx[INDEX_COLS].sort_values("rec_id")
+        idx.to_csv(OUT_INDEX, index=False)
+        write_sidecar(idx, OUT_INDEX)
+
+    db = bib_store.db_path(args.db)
+    if db:
+        # records rows are combined_raw positions, the same order df was read in
+        dup_of = dup_df.drop_duplicates("dup_id").set_index("dup_id")
+        with closing(bib_store.connect(db)) as con, step("store", rows=len(df)):
+            bib_store.update_dedupe(con, range(1, len(df) + 1), df["rec_id"], fp, df["norm_title"],
+                                    df["rec_id"].isin(kept_df["rec_id"]).astype(int),
+                                    df["rec_id"].map(dup_of["kept_id"]), df["rec_id"].map(dup_of["reason"]))
+        print(f"[OK] Updated dedupe keys in {db}")
 
     print(f"[OK] Wrote {OUT_MASTER} ({len(kept_df)} kept).")
     print(f"[OK] Wrote {OUT_DUPREP} ({len(dup_df)} duplicates).")
     print(f"[OK] Wrote {OUT_EXCL} ({len(excl_df)} excluded).")
+    bib_perf.finish(rows_in=len(df), kept=len(kept_df), duplicates=len(dup_df))
+    return kept_df
 
 if __name__ == "__main__":
     main()
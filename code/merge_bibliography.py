@@ -2,15 +2,14 @@
 # Merge RIS (Scopus/ERIC/WoS/CNKI…) + CSV (Google Scholar) into one table
 # Output: data_clean/combined_raw.csv
 
-import os, re, csv, sys
+import os, re, csv, sys, json, time, shutil, hashlib, argparse, tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from pathlib import Path
 import pandas as pd
-
-# optional: rispy for robust RIS parsing (workflow will install it)
-try:
-    import rispy  # type: ignore
-except Exception:
-    rispy = None
+import bib_perf, bib_store
+from bib_io import SidecarWriter, read_csv_any
+from bib_perf import step
 
 BASE = Path(__file__).resolve().parents[1]
 RIS_DIR = BASE / "data_raw" / "ris"
@@ -18,7 +17,10 @@ CSV_DIR = BASE / "data_raw" / "csv"
 OUT_DIR = BASE / "data_clean"
 OUT_DIR.mkdir(parents=True, exist_ok=True)
 
-STD_COLS = ["source_file", "src_type", "title", "authors", "year", "journal", "doi", "url", "abstract"]
+STD_COLS = ["source_file", "src_type", "title", "authors", "year", "journal", "doi", "url", "abstract",
+            "keywords", "issn", "volume", "issue", "pages"]
+CHUNK_ROWS = int(os.getenv("MERGE_CHUNK_ROWS", "5000"))  # rows held in memory before writing
+PARSER_VERSION = "4"  # bump whenever parsing/standardization changes, invalidates the cache
 
 def _norm_str(x):
     if pd.isna(x): return ""
@@ -31,71 +33,108 @@ def _clean_doi(x):
     x = x.replace("DOI:", "").replace("doi:", "").strip()
     return x.lower()
 
+def _norm_str_series(s):
+    return s.where(s.notna(), "").astype(str).str.strip()
+
+def _clean_doi_series(s):
+    # vectorized _clean_doi
+    s = _norm_str_series(s)
+    for pre in ("https://doi.org/", "http://doi.org/"):
+        s = s.str.replace(pre, "", regex=False)
+    s = s.str.strip()
+    for pre in ("DOI:", "doi:"):
+        s = s.str.replace(pre, "", regex=False)
+    return s.str.strip().str.lower()
+
 def _authors_to_str(auth_list):
     if not auth_list: return ""
     if isinstance(auth_list, str): return auth_list
     return "; ".join([str(a) for a in auth_list])
 
-def parse_ris_fallback(text: str):
-    # very small fallback parser (handles common RIS tags)
-    recs, cur = [], {}
-    for line in text.splitlines():
-        if not line.strip():  # allow blank lines within a record
-            continue
-        if re.match(r"^[A-Z0-9]{2}\s+-\s+", line):
-            tag, val = line.split(" - ", 1)
-            tag, val = tag.strip(), val.strip()
-            if tag == "TY":
-                cur = {}
-            elif tag == "ER":
-                if cur: recs.append(cur); cur = {}
-            elif tag in ("TI", "T1"): cur["title"] = val
-            elif tag in ("JO", "JF", "T2"): cur["journal"] = val
-            elif tag in ("PY", "Y1"):
-                m = re.search(r"\d{4}", val); cur["year"] = int(m.group()) if m else None
-            elif tag == "DO": cur["doi"] = val
-            elif tag == "UR": cur["url"] = val
-            elif tag == "AB": cur["abstract"] = val
-            elif tag == "AU":
-                cur.setdefault("authors", [])
-                cur["authors"].append(val)
-    return recs
-
-def load_ris_files():
-    rows = []
-    if not RIS_DIR.exists(): return pd.DataFrame(columns=STD_COLS)
-    for p in sorted(RIS_DIR.glob("*.ris")):
-        try:
-            if rispy is not None:
-                with open(p, "r", encoding="utf-8", errors="ignore") as f:
-                    entries = rispy.load(f)
-                for e in entries:
-                    rows.append({
-                        "source_file": p.name, "src_type": "ris",
-                        "title": _norm_str(e.get("title")),
-                        "authors": _authors_to_str(e.get("authors")),
-                        "year": e.get("year") or e.get("date"),
-                        "journal": _norm_str(e.get("journal_name") or e.get("secondary_title")),
-                        "doi": _clean_doi(e.get("doi")),
-                        "url": _norm_str(e.get("url")),
-                        "abstract": _norm_str(e.get("abstract")),
-                    })
-            else:
-                text = p.read_text(encoding="utf-8", errors="ignore")
-                for e in parse_ris_fallback(text):
-                    rows.append({
-                        "source_file": p.name, "src_type": "ris",
-                        "title": _norm_str(e.get("title")),
-                        "authors": _authors_to_str(e.get("authors")),
-                        "year": e.get("year"),
-                        "journal": _norm_str(e.get("journal")),
-                        "doi": _clean_doi(e.get("doi")),
-                        "url": _norm_str(e.get("url")),
-                        "abstract": _norm_str(e.get("abstract")),
-                    })
-        except Exception as ex:
-            print(f"[WARN] Failed to parse {p.name}: {ex}", file=sys.stderr)
-    return pd.DataFrame(rows, columns=STD_COLS)
+# "TY  - JOUR" / "ER  -" (RIS) and "RT Journal Article" (RefWorks tagged, CNKI)
+RIS_TAG = re.compile(r"^([A-Z][A-Z0-9])  ?-(?: (.*))?$")
+REFWORKS_TAG = re.compile(r"^(RT|SR|A[1-5]|AD|T[1-3]|JF|JO|YR|FD|VO|IS|SP|OP|K1|AB|NO|PB|PP|SN|CN|LA|DS|UL|LK|DO|CL|ED|WT|DB)(?: (.*))?$")
+
+def iter_ris_records(path):
+    """Yield one {tag: [values]} dict per record, reading the file line by line.
+
+    Untagged lines continue the previous field; repeated tags (AU, KW, AB, SN...)
+    keep every value.  Records end at ER (RIS) or at the next RT (RefWorks).
+    """
+    cur, last, tag_re = {}, None, None
+    with open(path, "r", encoding="utf-8-sig", errors="ignore") as f:
+        for line in f:
+            line = line.rstrip("\r\n").lstrip("\ufeff")
+            if tag_re is None:
+                # the first tagged line decides the dialect for the whole file
+                tag_re = next((r for r in (RIS_TAG, REFWORKS_TAG) if r.match(line)), None)
+            m = tag_re.match(line) if tag_re else None
+            if not m:
+                if line.strip() and last:
+                    vals = cur[last]
+                    vals[-1] = (vals[-1] + "\n" + line.strip()).strip()
+                continue
+            tag, val = m.group(1), (m.group(2) or "").strip()
+            if tag in ("TY", "RT"):
+                if cur: yield cur
+                cur, last = {}, None
+            if tag == "ER":
+                if cur: yield cur
+                cur, last = {}, None
+                continue
+            cur.setdefault(tag, []).append(val)
+            last = tag
+    if cur: yield cur
+
+def _split_list(vals):
+    # "a;b;" / continuation lines -> ["a", "b"]
+    out = []
+    for v in vals:
+        out.extend(x.strip() for x in re.split(r"[;\n]", v) if x.strip())
+    return out
+
+def ris_record_to_row(rec, source_file):
+    def first(*tags):
+        for t in tags:
+            for v in rec.get(t, ()):
+                if v.strip(): return v
+        return ""
+    def join(*tags, sep=" "):
+        return sep.join(v for t in tags for v in rec.get(t, ()) if v.strip())
+    m = re.search(r"\d{4}", first("PY", "Y1", "YR", "DA"))
+    authors = rec.get("AU") or _split_list(rec.get("A1", ()))
+    sp, ep = first("SP"), first("EP")
+    # RIS: SP/EP; CNKI RefWorks: OP holds the range ("11-17"), SP the start page
+    pages = f"{sp}-{ep}" if sp and ep else (first("OP") if "RT" in rec else "") or sp
+    return {
+        "source_file": source_file, "src_type": "ris",
+        "title": first("TI", "T1").replace("\n", " "),
+        "authors": _authors_to_str(authors),
+        "year": int(m.group()) if m else "",
+        "journal": first("JO", "T2", "JF"),
+        "doi": _clean_doi(first("DO")),
+        "url": first("UR", "UL"),
+        "abstract": join("AB", "N2").replace("\n", " "),
+        "keywords": "; ".join(_split_list(rec.get("KW", []) + rec.get("K1", []))),
+        "issn": "; ".join(_split_list(rec.get("SN", ()))),
+        "volume": first("VL", "VO"),
+        "issue": first("IS"),
+        "pages": pages,
+    }
+
+def read_ris_file(p):
+    for rec in iter_ris_records(p):
+        yield ris_record_to_row(rec, p.name)
+
+def iter_chunks(rows, size=None):
+    size = size or CHUNK_ROWS
+    buf = []
+    for r in rows:
+        buf.append(r)
+        if len(buf) >= size:
+            yield pd.DataFrame(buf, columns=STD_COLS); buf = []
+    if buf:
+        yield pd.DataFrame(buf, columns=STD_COLS)
 
 # map common CSV headers from Google Scholar/others to our standard names
 CSV_HEADER_MAP = {
@@ -111,64 +150,178 @@ CSV_HEADER_MAP = {
     "link": "url",
     "abstract": "abstract",
     "description": "abstract",
+    "keywords": "keywords",
+    "author keywords": "keywords",
+    "issn": "issn",
+    "volume": "volume",
+    "issue": "issue",
+    "pages": "pages",
 }
 
-def load_csv_files():
-    frames = []
-    if not CSV_DIR.exists(): return pd.DataFrame(columns=STD_COLS)
-    for p in sorted(CSV_DIR.glob("*.csv")):
-        df = None
-        for enc in ("utf-8", "utf-8-sig", "latin-1", "gb18030"):
-            try:
-                df = pd.read_csv(p, encoding=enc)
-                break
-            except Exception:
-                continue
-        if df is None:
-            print(f"[WARN] Failed to read {p.name} with common encodings.", file=sys.stderr)
-            continue
-        # normalize headers
-        df_cols = [str(c).strip().lower() for c in df.columns]
-        df.columns = df_cols
-        out = {k: "" for k in STD_COLS}
-        out_rows = []
-        for _, row in df.iterrows():
-            rec = {k: "" for k in STD_COLS}
-            rec["source_file"] = p.name
-            rec["src_type"] = "csv"
-            for c in df.columns:
-                key = CSV_HEADER_MAP.get(c)
-                if not key: continue
-                val = row[c]
-                if key == "year":
-                    try:
-                        m = re.search(r"\d{4}", str(val))
-                        rec["year"] = int(m.group()) if m else ""
-                    except Exception:
-                        rec["year"] = ""
-                elif key == "doi":
-                    rec["doi"] = _clean_doi(val)
-                else:
-                    rec[key] = _norm_str(val)
-            out_rows.append(rec)
-        frames.append(pd.DataFrame(out_rows, columns=STD_COLS))
-    if frames:
-        return pd.concat(frames, ignore_index=True)
-    return pd.DataFrame(columns=STD_COLS)
-
-def main():
-    ris_df = load_ris_files()
-    csv_df = load_csv_files()
-    combined = pd.concat([ris_df, csv_df], ignore_index=True)
+def read_csv_file(p, chunksize=None):
+    # encoding sniffed once (GB18030 exports used to be decoded as latin-1);
+    # read as text so every chunk parses the same; with chunksize, yields
+    # standardized blocks instead of one frame
+    if chunksize:
+        return (_std_csv(df, p) for df in read_csv_any(p, chunksize=chunksize, dtype=str))
+    return _std_csv(read_csv_any(p, dtype=str), p)
+
+def _std_csv(df, p):
+    # normalize headers; when several headers map to one field the last one wins
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    out = pd.DataFrame({k: "" for k in STD_COLS}, index=df.index)
+    out["source_file"] = p.name
+    out["src_type"] = "csv"
+    for k, c in enumerate(df.columns):
+        key = CSV_HEADER_MAP.get(c)
+        if not key: continue
+        col = df.iloc[:, k]
+        if key == "year":
+            y = col.astype(str).str.extract(r"(\d{4})", expand=False)
+            out["year"] = y.map(lambda v: int(v) if isinstance(v, str) else "")
+        elif key == "doi":
+            out["doi"] = _clean_doi_series(col)
+        else:
+            out[key] = _norm_str_series(col)
+    return out.reset_index(drop=True)
+
+def _finalize(df):
     # final cleaning
-    combined["title"] = combined["title"].fillna("").str.strip()
-    combined["authors"] = combined["authors"].fillna("").str.strip()
-    combined["journal"] = combined["journal"].fillna("").str.strip()
-    combined["doi"] = combined["doi"].apply(_clean_doi)
-    combined["url"] = combined["url"].fillna("").str.strip()
-    combined["abstract"] = combined["abstract"].fillna("").str.strip()
-    combined.to_csv(OUT_DIR / "combined_raw.csv", index=False)
-    print(f"[OK] Wrote {OUT_DIR / 'combined_raw.csv'} with {len(combined)} rows.")
+    for c in ("title", "authors", "journal", "url", "abstract", "keywords", "issn", "volume", "issue", "pages"):
+        df[c] = df[c].fillna("").astype(str).str.strip()
+    df["doi"] = _clean_doi_series(df["doi"])
+    return df
+
+def input_files():
+    # RIS first, then CSV, each sorted by name - this order is the output order
+    files = []
+    for d, pat in ((RIS_DIR, "*.ris"), (CSV_DIR, "*.csv")):
+        if d.exists(): files += sorted(d.glob(pat))
+    return files
+
+def ingest_file(path, part):
+    """Parse one export into a standardized CSV part file.
+
+    Runs in a worker process under --jobs; warnings are returned instead of
+    printed so the parent can report them per file.
+    """
+    t0, n, warnings = time.perf_counter(), 0, []
+    def chunks():
+        if path.suffix.lower() == ".ris":
+            yield from iter_chunks(read_ris_file(path))
+        else:
+            yield from read_csv_file(path, chunksize=CHUNK_ROWS)
+    with open(part, "w", encoding="utf-8", newline="") as f:
+        try:
+            for chunk in chunks():
+                _finalize(chunk).to_csv(f, index=False, header=(f.tell() == 0))
+                n += len(chunk)
+        except Exception as ex:
+            warnings.append(f"Failed to parse {path.name}: {ex}")
+        if f.tell() == 0:
+            pd.DataFrame(columns=STD_COLS).to_csv(f, index=False)
+    return {"file": path.name, "rows": n, "seconds": time.perf_counter() - t0, "warnings": warnings}
+
+def file_key(path):
+    # cache key: parser version + file name (it ends up in source_file) + content
+    h = hashlib.sha256(f"{PARSER_VERSION}|{path.name}|".encode("utf-8"))
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()[:32]
+
+def main(argv=None):
+    # returns combined_raw as a frame when it was read back anyway (store), else None
+    global RIS_DIR, CSV_DIR, OUT_DIR
+    ap = argparse.ArgumentParser(description="Merge RIS/CSV exports into combined_raw.csv")
+    ap.add_argument("--raw", type=Path, default=None, help="raw exports dir (ris/ and csv/ inside)")
+    ap.add_argument("--out", type=Path, default=None, help="output dir")
+    ap.add_argument("--jobs", type=int, default=1, help="parse files in N processes (0 = all cores)")
+    ap.add_argument("--no-cache", action="store_true", help="re-parse every file, ignore out/.cache")
+    ap.add_argument("--db", nargs="?", const="", default=None,
+                    help="also update the SQLite record store (default path data_clean/bib.sqlite, or $BIB_DB)")
+    bib_perf.add_args(ap)
+    args = ap.parse_args(argv)
+    if args.raw: RIS_DIR, CSV_DIR = args.raw / "ris", args.raw / "csv"
+    if args.out: OUT_DIR = args.out; OUT_DIR.mkdir(parents=True, exist_ok=True)
+    jobs = args.jobs or os.cpu_count() or 1
+    cache = None if args.no_cache else OUT_DIR / ".cache" / "merge"
+    if cache: cache.mkdir(parents=True, exist_ok=True)
+    bib_perf.start("merge", args)
+
+    # every file becomes a part file (RIS streamed in CHUNK_ROWS blocks). Parts of
+    # unchanged files come from the cache; the rest are parsed (in parallel with
+    # --jobs) and the parts are concatenated in file order, so the output doesn't
+    # depend on --jobs or on what was cached. The Parquet sidecar is written from
+    # the same parts, CHUNK_ROWS at a time, so memory stays bounded with it on.
+    files = input_files()
+    with step("hash inputs", rows=len(files)):
+        keys = [file_key(p) for p in files] if cache else [None] * len(files)
+    out, parts, results = OUT_DIR / "combined_raw.csv", [None] * len(files), [None] * len(files)
+    with tempfile.TemporaryDirectory(dir=OUT_DIR) as tmp:
+        todo = []
+        for k, (p, key) in enumerate(zip(files, keys)):
+            if key and (cache / f"{key}.json").exists() and (cache / f"{key}.csv").exists():
+                meta = json.loads((cache / f"{key}.json").read_text(encoding="utf-8"))
+                parts[k], results[k] = cache / f"{key}.csv", dict(meta, seconds=0.0, cached=True)
+                print(f"[CACHE] hit   {p.name}")
+            else:
+                parts[k] = Path(tmp) / f"{k:05d}.csv"
+                todo.append(k)
+                if key: print(f"[CACHE] miss  {p.name}")
+        with step("parse files") as st:
+            pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and len(todo) > 1 else None
+            try:
+                run = pool.map if pool else map
+                for k, res in zip(todo, run(ingest_file, [files[k] for k in todo], [parts[k] for k in todo])):
+                    results[k] = dict(res, cached=False)
+                    if keys[k] and not res["warnings"]:
+                        # only clean parses are cached, so failures are retried next run
+                        parts[k] = Path(shutil.move(parts[k], cache / f"{keys[k]}.csv"))
+                        (cache / f"{keys[k]}.json").write_text(
+                            json.dumps({"file": res["file"], "rows": res["rows"], "warnings": []}), encoding="utf-8")
+            finally:
+                if pool: pool.shutdown()
+            st["rows"] = sum(results[k]["rows"] for k in todo)
+        with step("concatenate", rows=sum(r["rows"] for r in results)):
+            side = SidecarWriter(out)
+            with open(out, "w", encoding="utf-8", newline="") as f:
+                for k, part in enumerate(parts):
+                    with open(part, "r", encoding="utf-8", newline="") as g:
+                        if k: g.readline()  # header only once
+                        shutil.copyfileobj(g, f)
+                    if side.ok:
+                        for chunk in pd.read_csv(part, dtype=str, chunksize=CHUNK_ROWS):
+                            side.write(chunk)
+                if not files:
+                    pd.DataFrame(columns=STD_COLS).to_csv(f, index=False)
+            side = side.close()
+
+    if cache:
+        # drop entries for files that changed or disappeared
+        live = set(keys)
+        for q in cache.iterdir():
+            if q.stem not in live: q.unlink()
+        hits = sum(r["cached"] for r in results)
+        print(f"[CACHE] {hits} hits, {len(results) - hits} parsed.")
+        bib_perf.note(cache_hits=hits)
+    for r in sorted(results, key=lambda r: -r["seconds"]):
+        if not r["cached"]:
+            print(f"[TIME] {r['seconds']:7.2f}s {r['rows']:7d} rows  {r['file']}")
+    for r in results:
+        for w in r["warnings"]:
+            print(f"[WARN] {w}", file=sys.stderr)
+    print(f"[OK] Wrote {out} with {sum(r['rows'] for r in results)} rows.")
+    if side: print(f"[OK] Wrote {side}")
+    db = bib_store.db_path(args.db)
+    combined = None
+    if db:  # the store loads the whole table
+        combined = pd.read_csv(out, dtype=str)
+        with closing(bib_store.connect(db)) as con, step("store", rows=len(combined)):
+            print(f"[OK] Loaded {bib_store.load_records(con, combined)} records into {db}")
+    bib_perf.finish(rows_out=sum(r["rows"] for r in results), files=[
+        {k: r[k] for k in ("file", "rows", "seconds", "cached")} for r in results])
+    return combined
 
 if __name__ == "__main__":
     main()
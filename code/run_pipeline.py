@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# run_pipeline.py
+# One entry point for merge -> dedupe -> screening sheet -> autoscreen -> Rayyan export.
+#   python code/run_pipeline.py                  -> run whatever is out of date
+#   python code/run_pipeline.py --dry-run        -> only say what would run and why
+#   python code/run_pipeline.py --only autoscreen rayyan
+#   python code/run_pipeline.py --force          -> run everything
+#   python code/run_pipeline.py --check-ids      -> also check 06 gives the same study_ids
+#                                                   from memory, the sidecar and the CSV
+# Each stage declares its inputs and outputs (STAGES). A stage is skipped when
+# the content hashes of its inputs (data files, its own script, the shared bib_*
+# modules, its arguments and the environment settings in ENV_KEYS) match the
+# last successful run and its outputs are still there; the hashes are
+# kept in data_clean/.cache/pipeline.json. Stages still write their files, but a
+# stage that just ran hands its result to the next one as a DataFrame, so it is
+# not read back from disk in the same process.
+# An output people edit by hand (the screening sheet) is not overwritten unless
+# --force; the stages that read it are then stopped and the run exits 1, so it
+# never ends OK on results from two different sources.
+
+import os, sys, json, glob, hashlib, argparse, importlib, time
+from pathlib import Path
+
+BASE = Path(__file__).resolve().parents[1]
+STATE = Path("data_clean") / ".cache" / "pipeline.json"
+
+# inputs: files or globs (relative to the repo root) whose content decides whether
+#         the stage must run; the stage's own script is always one of them
+# outputs: files it writes; the first one is what it returns as a DataFrame
+# frame_from: the upstream output whose DataFrame is passed in (df=) when it is in memory
+# load: how to read frame_from when it isn't, if the script's own default input differs
+# protect: outputs people edit by hand - not overwritten unless the pipeline wrote them
+STAGES = [
+    {"name": "merge", "module": "merge_bibliography",
+     "inputs": ["data_raw/ris/*.ris", "data_raw/csv/*.csv"],
+     "outputs": ["data_clean/combined_raw.csv"],
+     "argv": ["--raw", "data_raw", "--out", "data_clean"]},
+    {"name": "dedupe", "module": "dedupe_bibliography",
+     "inputs": ["data_clean/combined_raw.csv"],
+     "outputs": ["data_clean/master_bibliography.csv", "data_clean/duplicates_report.csv",
+                 "data_clean/excluded_duplicates.csv", "data_clean/dedupe_index.csv"],
+     "frame_from": "data_clean/combined_raw.csv"},
+    {"name": "screening_sheet", "module": "06_make_screening_sheet",
+     "inputs": ["data_clean/master_bibliography.csv"],
+     "outputs": ["data_clean/TitleAbs_Screening.xlsx"],
+     "frame_from": "data_clean/master_bibliography.csv", "load": "read_any",
+     "protect": ["data_clean/TitleAbs_Screening.xlsx"]},
+    {"name": "autoscreen", "module": "07_autoscreen",
+     "inputs": ["data_clean/TitleAbs_Screening.xlsx", os.getenv("AUTOSCREEN_RULES", "code/autoscreen_rules.json")],
+     "outputs": ["data_clean/TitleAbs_Screening_AUTO.xlsx"],
+     "frame_from": "data_clean/TitleAbs_Screening.xlsx"},
+    {"name": "rayyan", "module": "08_make_rayyan_csv",
+     "inputs": ["data_clean/TitleAbs_Screening_AUTO.xlsx"],
+     "outputs": ["data_clean/rayyan_upload_v1.csv"],
+     "frame_from": "data_clean/TitleAbs_Screening_AUTO.xlsx"},
+]
+NAMES = [s["name"] for s in STAGES]
+SHARED = ["code/bib_*.py"]  # imported by the stages, so an input of each
+ENV_KEYS = ("TITLE_SIM_THRESHOLD", "BIB_PARQUET", "AUTOSCREEN_RULES")  # settings that change outputs
+UNKEYED = ("--jobs",)  # options (with their value) that don't change outputs, left out of the key
+DB_STAGES = ("merge", "dedupe", "screening_sheet", "autoscreen")  # the ones with --db
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def input_files(stage):
+    files = [f"code/{stage['module']}.py"]
+    for pat in SHARED + stage["inputs"]:
+        files += sorted(glob.glob(pat)) if glob.has_magic(pat) else [pat]
+    return files
+
+def stage_key(stage, argv):
+    # one hash over the inputs' names and contents plus the arguments and settings;
+    # a missing input counts too, so it appearing later triggers a run
+    argv = [a for k, a in enumerate(argv) if a not in UNKEYED and (k == 0 or argv[k-1] not in UNKEYED)]
+    h = hashlib.sha256(json.dumps([argv, {k: os.getenv(k) for k in ENV_KEYS}]).encode("utf-8"))
+    for f in input_files(stage):
+        h.update(f"\0{f}\0{file_hash(f) if os.path.exists(f) else '-'}".encode("utf-8"))
+    return h.hexdigest()
+
+def load_state():
+    try:
+        return json.loads(STATE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state):
+    STATE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = STATE.with_name(STATE.name + ".tmp")
+    tmp.write_text(json.dumps(state, indent=1), encoding="utf-8")
+    os.replace(tmp, STATE)
+
+def why_run(stage, key, state, force):
+    """Reason the stage must run, or None when it is up to date."""
+    if force: return "forced"
+    prev = state.get(stage["name"])
+    if not prev: return "never run"
+    if prev["key"] != key: return "inputs changed"
+    missing = [o for o in stage["outputs"] if not os.path.exists(o)]
+    if missing: return f"missing {', '.join(missing)}"
+    return None
+
+def edited_outputs(stage, state):
+    # protected outputs that exist but are not the file this pipeline last wrote
+    written = state.get(stage["name"], {}).get("outputs", {})
+    return [o for o in stage.get("protect", ())
+            if os.path.exists(o) and written.get(o) != file_hash(o)]
+
+def stage_argv(stage, args):
+    argv = list(stage.get("argv", ()))
+    if stage["name"] == "merge": argv += ["--jobs", str(args.jobs)]
+    if stage["name"] == "dedupe" and args.incremental: argv.append("--incremental")
+    if args.db is not None and stage["name"] in DB_STAGES: argv += ["--db"] + ([args.db] if args.db else [])
+    return argv
+
+def check_ids(frames, args):
+    """06's study_ids for master_bibliography as the runner can hand it over:
+    the frame dedupe returned, its Parquet sidecar, and the CSV. True if they agree.
+
+    Decisions are keyed by study_id (store, shard merge), so a stage that ran in
+    this process and one that was skipped must give the same ids.
+    """
+    src = STAGES[NAMES.index("screening_sheet")]["frame_from"]
+    sheet = importlib.import_module("06_make_screening_sheet")
+    from bib_io import read_csv_any, read_sidecar
+    mem = frames.get(src)
+    if mem is None:  # dedupe was skipped: run it again for its frame (same outputs)
+        dedupe = STAGES[NAMES.index("dedupe")]
+        mem = importlib.import_module(dedupe["module"]).main(stage_argv(dedupe, args))
+    ways = {"memory": mem, "sidecar": read_sidecar(src, dtype=str),
+            "csv": read_csv_any(src, dtype=str).fillna("")}
+    ids = {k: sheet.build_sheet(df)["study_id"].tolist() for k, df in ways.items() if df is not None}
+    if "sidecar" not in ids: print("[INFO] no current sidecar (pyarrow missing or BIB_PARQUET=0); checked memory vs csv")
+    ok = True
+    for k, got in ids.items():
+        same = sum(a == b for a, b in zip(got, ids["csv"]))
+        if len(got) != len(ids["csv"]) or same != len(got):
+            print(f"[WARN] study_id from {k} vs csv: {same} of {len(got)} agree", file=sys.stderr)
+            ok = False
+    if ok: print(f"[OK] study_ids agree across {', '.join(ids)} ({len(ids['csv'])} records).")
+    return ok
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Run the bibliography pipeline, skipping stages that are up to date")
+    ap.add_argument("--only", nargs="+", choices=NAMES, metavar="STAGE",
+                    help=f"consider only these stages ({', '.join(NAMES)})")
+    ap.add_argument("--force", action="store_true",
+                    help="run every selected stage, and overwrite hand-edited outputs")
+    ap.add_argument("--dry-run", action="store_true", help="print what would run and why, run nothing")
+    ap.add_argument("--jobs", type=int, default=0, help="merge: parse files in N processes (0 = all cores)")
+    ap.add_argument("--incremental", action="store_true", help="dedupe: only match new records")
+    ap.add_argument("--db", nargs="?", const="", default=None,
+                    help="pass --db to the stages that keep the SQLite store (default path data_clean/bib.sqlite)")
+    ap.add_argument("--check-ids", action="store_true",
+                    help="afterwards, check 06 gives the same study_ids however it gets master_bibliography")
+    args = ap.parse_args(argv)
+    os.chdir(BASE)  # 06/07/08 use paths relative to the repo root
+    sys.path.insert(0, str(BASE / "code"))
+
+    state = load_state()
+    frames = {}  # output path -> DataFrame produced in this process
+    ran, skipped, stopped = [], [], []
+    pending = set()  # --dry-run: outputs of stages that would run (so their hashes can't be known yet)
+    held = {}  # outputs kept back (hand-edited, or downstream of one) -> the stage that held them
+    for stage in STAGES:
+        name = stage["name"]
+        if args.only and name not in args.only:
+            continue
+        stale = held.keys() & set(stage["inputs"])
+        if stale:
+            # running on a kept-back input would mix it with the new upstream results
+            src = held[sorted(stale)[0]]
+            print(f"[STOP] {name:<16} {src} was kept back")
+            held.update(dict.fromkeys(stage["outputs"], src))
+            stopped.append(name)
+            continue
+        argv_s = stage_argv(stage, args)
+        key = stage_key(stage, argv_s)
+        reason = why_run(stage, key, state, args.force)
+        if reason is None and pending.intersection(stage["inputs"]):
+            reason = "upstream would run"
+        if reason is None:
+            print(f"[SKIP] {name:<16} up to date")
+            skipped.append(name)
+            continue
+        edited = [] if args.force else edited_outputs(stage, state)
+        if edited:
+            # e.g. a screening sheet with reviewer decisions in it
+            print(f"[WARN] {name}: {', '.join(edited)} was edited since the pipeline wrote it; "
+                  f"not overwriting it (pass --force to replace it)", file=sys.stderr)
+            held.update(dict.fromkeys(stage["outputs"], name))
+            stopped.append(name)
+            continue
+        print(f"[RUN]  {name:<16} {reason}")
+        if args.dry_run:
+            pending.update(stage["outputs"])
+            continue
+        mod = importlib.import_module(stage["module"])
+        src, df = stage.get("frame_from"), None
+        if src:
+            df = frames.get(src)
+            if df is None and stage.get("load") and os.path.exists(src):
+                df = getattr(mod, stage["load"])(src)
+        t0 = time.perf_counter()
+        out = mod.main(argv_s, df=df) if src else mod.main(argv_s)
+        print(f"[TIME] {name} {time.perf_counter()-t0:.2f}s")
+        if out is not None:
+            frames[stage["outputs"][0]] = out
+        state[name] = {"key": key,
+                       "outputs": {o: file_hash(o) for o in stage["outputs"] if os.path.exists(o)},
+                       "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        save_state(state)
+        ran.append(name)
+    stop_note = f"; stopped {len(stopped)}: {', '.join(stopped)}" if stopped else ""
+    print(f"[{'WARN' if stopped else 'OK'}] ran {len(ran)} stage(s){': ' + ', '.join(ran) if ran else ''}; "
+          f"skipped {len(skipped)}{': ' + ', '.join(skipped) if skipped else ''}{stop_note}.")
+    if stopped:
+        # the outputs of the stopped stages still come from an earlier source
+        print("[WARN] not up to date: rerun with --force to replace the hand-edited file, "
+              "or move it aside", file=sys.stderr)
+        sys.exit(1)
+    if args.check_ids and not args.dry_run and not check_ids(frames, args):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()